@@ -1,105 +1,312 @@
-import os
+import argparse
+import io
+import multiprocessing
+import re
 import sys
 import types
+from collections import OrderedDict
+from itertools import islice
 from pathlib import Path
+from typing import Iterator
 
-import psycopg2
 from adblockparser import AdblockRules
-from psycopg2.extras import execute_values
 from psycopg2.sql import SQL
 from tqdm import tqdm
 
+import db_pool
+import experiment_view
+import metrics
+from db_pool import PooledSession
+from adblock_engine import ENGINES, FastRules, create_matcher
+from experiment_view import REQUEST_TABLE
 from request import Request
+from rule_cache import CacheStatus, load_rules
+
+
+FILTER_LIST_DIR = Path(__file__).with_name("filterlists")
+URL_CACHE_SIZE = 1_000_000
+MATCH_CHUNK_SIZE = 1_000
+EXPERIMENT_REQUESTS_QUERY = ("SELECT r.id, r.scheme, r.host, r.path "
+                             "FROM interfaceanalysis ia "
+                             "INNER JOIN trafficcollection tc on tc.analysis = ia.id "
+                             "INNER JOIN request r on r.run = tc.id "
+                             "WHERE ia.experiment = %s")
+VIEW_REQUESTS_QUERY = ("SELECT er.request_id, er.scheme, er.host, er.path "
+                       f"FROM {REQUEST_TABLE} er "
+                       "WHERE er.experiment = %s")
 
 
 def main():
-    experiment_id = int(sys.argv[1])
-    filter_list_name = sys.argv[2]
+    parser = argparse.ArgumentParser(description="match the requests of an experiment against adblock filter lists")
+    parser.add_argument("experiment_id", type=int)
+    parser.add_argument("filter_lists", help="a filter list name, comma separated names or 'all'")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used for matching")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="stream the requests from a server side cursor in chunks of this size")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only match requests without a result for the current version of a list")
+    parser.add_argument("--engine", choices=ENGINES, default=ENGINES[0],
+                        help="match with adblockparser or with the indexed engine, which falls back to "
+                             "adblockparser for urls it cannot handle")
+    db_pool.add_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    db_pool.configure_from_args(args)
+    metrics.configure_from_args(f"adblock_addon:{args.experiment_id}", args)
+
+    addon = AdBlockAddon(parse_filter_list_names(args.filter_lists), workers=args.workers, engine=args.engine)
+    try:
+        addon.match_requests(args.experiment_id, args.chunk_size, args.incremental)
+    finally:
+        addon.close()
+        db_pool.close()
+        metrics.finish()
+
+
+def parse_filter_list_names(argument: str) -> list[str]:
+    if argument == "all":
+        return sorted(p.stem for p in FILTER_LIST_DIR.glob("*.txt"))
+    return [name.strip() for name in argument.split(",") if name.strip() != ""]
+
+
+def request_url(request: Request) -> str:
+    path = "" if request.path is None else request.path
+    return f"{request.scheme}://{request.host}/{path}"
+
+
+def group_by_url(requests: list[Request]) -> dict[str, list[Request]]:
+    urls: dict[str, list[Request]] = dict()
+    for r in requests:
+        urls.setdefault(request_url(r), []).append(r)
+    return urls
+
+
+class MatchStats:
+    def __init__(self):
+        self.requests = 0
+        self.hits = 0
+        self.urls = 0
+        self.cache_hits = 0
+
+    def add(self, requests: list[Request], urls: int, cache_hits: int) -> None:
+        self.requests += len(requests)
+        self.hits += len([1 for r in requests if r.match is True])
+        self.urls += urls
+        self.cache_hits += cache_hits
+
+    def __str__(self):
+        return (f"matches {self.hits} out of {self.requests} requests "
+                f"({(self.hits / max(self.requests, 1) * 100):.8f} %), "
+                f"{self.urls} distinct urls, url cache hit rate {(self.cache_hits / max(self.urls, 1) * 100):.2f} %")
+
+
+class UrlCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[str, str], bool] = OrderedDict()
+
+    def get(self, filter_list_name: str, url: str) -> bool | None:
+        key = (filter_list_name, url)
+        match = self._entries.get(key)
+        if match is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return match
+
+    def put(self, filter_list_name: str, url: str, match: bool) -> None:
+        self._entries[(filter_list_name, url)] = match
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._entries.clear()
+
+
+# rules of the worker processes, inherited on fork or loaded from the rule cache
+_worker_rules: dict[str, AdblockRules | FastRules] = dict()
+
+
+def _init_worker(filter_list_names: list[str], engine: str) -> None:
+    for filter_list_name in filter_list_names:
+        if filter_list_name not in _worker_rules:
+            rules, _ = load_rules(FILTER_LIST_DIR / f"{filter_list_name}.txt")
+            _worker_rules[filter_list_name] = create_matcher(rules, engine)
 
-    addon = AdBlockAddon(filter_list_name)
-    addon.match_requests(experiment_id)
 
+def _match_chunk(task: tuple[str, list[str]]) -> list[bool]:
+    filter_list_name, urls = task
+    rules = _worker_rules[filter_list_name]
+    return [rules.should_block(url) for url in urls]
 
-class AdBlockAddon:
 
-    def __init__(self, filter_list_name: str):
+class AdBlockAddon(PooledSession):
+
+    def __init__(self, filter_list_names: list[str], workers: int = 1, engine: str = ENGINES[0]):
+        super().__init__()
         self.sql = types.SimpleNamespace()
         self.sql.plugin_schema = "pluginadblock"
         self.sql.request_match_table = "requestmatch"
         self.sql.list_name_table = "filterlist"
-        self.conn = psycopg2.connect(host=os.environ['POSTGRES_HOST'] or 'localhost', port=os.environ['HOST_PORT'],
-                                     dbname=os.environ['POSTGRES_DB'], user=os.environ['POSTGRES_USER'],
-                                     password=os.environ['POSTGRES_PASSWORD'])
-        self.cur = self.conn.cursor()
-
-        self.filter_list_name = filter_list_name
-        file_path = Path(__file__).with_name(f"{filter_list_name}.txt")
-        with open(file_path) as filter_list:
-            raw_rules = filter_list.readlines()
-        self.rules = AdblockRules(raw_rules, max_mem=2 * 1024 * 1024 * 1024)
-
-    def match_requests(self, experiment_id: int) -> None:
-        # get request for experiment
-        requests = self._get_experiment_requests(experiment_id)
-        print(f"matching {len(requests)} requests using {self.filter_list_name}")
-        for r in tqdm(requests):
-            path = "" if r.path is None else r.path
-            if self.rules.should_block(f"{r.scheme}://{r.host}/{path}"):
-                r.match = True
+        self.sql.request_match_load_table = "requestmatch_load"
+
+        self.rules: dict[str, AdblockRules] = dict()
+        self.cache_status: dict[str, CacheStatus] = dict()
+        for filter_list_name in filter_list_names:
+            file_path = FILTER_LIST_DIR / f"{filter_list_name}.txt"
+            try:
+                self.rules[filter_list_name], self.cache_status[filter_list_name] = load_rules(file_path)
+            except re.error as e:
+                # e.g. ruadlist, whose rules adblockparser joins into a regex python cannot compile
+                print(f"skipping {filter_list_name}, its rules cannot be compiled: {e}", file=sys.stderr)
+        self.engine = engine
+        self.matchers: dict[str, AdblockRules | FastRules] = \
+            {name: create_matcher(rules, engine) for name, rules in self.rules.items()}
+        self.workers = workers
+        # shared by all lists and kept for the lifetime of the addon, i.e. across experiments
+        self.url_cache = UrlCache(URL_CACHE_SIZE)
+
+    def match_requests(self, experiment_id: int, chunk_size: int | None = None, incremental: bool = False) -> None:
+        # get request for experiment once and evaluate every list on each distinct url,
+        # either for all requests at once or chunk by chunk from a server side cursor
+        run = self.start_run(experiment_id, incremental)
+        try:
+            if chunk_size is None:
+                with metrics.stage("fetch"):
+                    chunks = [self._get_experiment_requests(experiment_id)]
+            else:
+                chunks = metrics.TimedIterator(self._stream_experiment_requests(experiment_id, chunk_size), "fetch")
+            for chunk in chunks:
+                run.match_chunk(chunk)
+        finally:
+            run.close()
+
+    def start_run(self, experiment_id: int, incremental: bool = False,
+                  list_versions: dict[str, tuple[int, int]] | None = None) -> "MatchRun":
+        # the caller hands the requests of the experiment to the run chunk by chunk,
+        # optionally only for some of the lists with their versions from list_versions
+        if list_versions is None:
+            list_versions = self.list_versions()
+        # requests that already have a result for the current version of a list are skipped
+        up_to_date: dict[str, set[int]] = dict()
+        for filter_list_name, (list_id, version) in list_versions.items():
+            up_to_date[filter_list_name] = \
+                self._get_existing_matches(experiment_id, list_id, version) if incremental else set()
+            print(f"{filter_list_name} version {version}: {len(up_to_date[filter_list_name])} requests up to date")
+        return MatchRun(self, list_versions, up_to_date)
+
+    def list_versions(self) -> dict[str, tuple[int, int]]:
+        self._ensure_schema()
+        return {name: self._ensure_filter_list(name, self.cache_status[name].digest) for name in self.rules}
+
+    def match_urls(self, filter_list_name: str, urls: list[str], pool=None) -> dict[str, bool]:
+        matches: dict[str, bool] = dict()
+        pending: list[str] = list()
+        for url in urls:
+            match = self.url_cache.get(filter_list_name, url)
+            if match is None:
+                pending.append(url)
+            else:
+                matches[url] = match
+
+        with tqdm(total=len(urls), initial=len(matches)) as progress:
+            if pool is None:
+                rules = self.matchers[filter_list_name]
+                for url in pending:
+                    matches[url] = rules.should_block(url)
+                    progress.update()
             else:
-                r.match = False
+                chunks = [pending[i:i + MATCH_CHUNK_SIZE] for i in range(0, len(pending), MATCH_CHUNK_SIZE)]
+                tasks = [(filter_list_name, chunk) for chunk in chunks]
+                for chunk, chunk_matches in zip(chunks, pool.imap(_match_chunk, tasks)):
+                    matches.update(zip(chunk, chunk_matches))
+                    progress.update(len(chunk))
+        for url in pending:
+            self.url_cache.put(filter_list_name, url, matches[url])
+        return matches
+
+    def _create_pool(self):
+        # workers started by fork share the already compiled rules, others load them from the rule cache
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        if start_method == "fork":
+            _worker_rules.update(self.matchers)
+        context = multiprocessing.get_context(start_method)
+        return context.Pool(self.workers, initializer=_init_worker,
+                            initargs=(list(self.rules.keys()), self.engine))
 
-        num_hits = len([1 for r in requests if r.match is True])
-        print(f"{self.filter_list_name} matches {num_hits} out of {len(requests)} requests "
-              f"({(num_hits / len(requests) * 100):.8f} %)")
-        self._save_results(requests, )
+    def _experiment_requests_query(self, experiment_id: int) -> str:
+        return VIEW_REQUESTS_QUERY if experiment_view.is_current(self.cur, experiment_id) else EXPERIMENT_REQUESTS_QUERY
 
     def _get_experiment_requests(self, experiment_id: int) -> list[Request]:
-        self.cur.execute("SELECT r.id, r.scheme, r.host, r.path "
-                         "FROM interfaceanalysis ia "
-                         "INNER JOIN trafficcollection tc on tc.analysis = ia.id "
-                         "INNER JOIN request r on r.run = tc.id "
-                         "WHERE ia.experiment = %s",
-                         (experiment_id,))
+        self.cur.execute(self._experiment_requests_query(experiment_id), (experiment_id,))
         self.conn.commit()
         return [Request(r[0], r[1], r[2], r[3]) for r in self.cur.fetchall()]
 
-    def _get_existing_matches(self, experiment_id: int) -> list[tuple[int, bool]]:
-        self.cur.execute(SQL(f"SELECT request_id, match "
-                             f"FROM {self.sql.request_match_table} "
-                             f"WHERE list_id = %s"),
-                         (experiment_id,))
-        self.conn.commit()
-        return self.cur.fetchall()
+    def _stream_experiment_requests(self, experiment_id: int, chunk_size: int) -> Iterator[list[Request]]:
+        # with hold, as saving the results commits while the cursor is still open
+        query = self._experiment_requests_query(experiment_id)
+        cur = self.conn.cursor(name=f"experiment_requests_{experiment_id}", withhold=True)
+        cur.itersize = chunk_size
+        try:
+            cur.execute(query, (experiment_id,))
+            while True:
+                rows = list(islice(cur, chunk_size))
+                if not rows:
+                    break
+                yield [Request(r[0], r[1], r[2], r[3]) for r in rows]
+        finally:
+            cur.close()
+            self.conn.commit()
 
-    def _save_results(self, requests: list[Request]) -> None:
-        print("saving the results to the database")
-        self._ensure_schema()
-        list_id = self._ensure_filter_list(self.filter_list_name)
+    def _get_existing_matches(self, experiment_id: int, list_id: int, list_version: int) -> set[int]:
+        if experiment_view.is_current(self.cur, experiment_id):
+            requests = f"INNER JOIN {REQUEST_TABLE} er on er.request_id = rm.request_id WHERE er.experiment = %s "
+        else:
+            requests = (f"INNER JOIN request r on r.id = rm.request_id "
+                        f"INNER JOIN trafficcollection tc on tc.id = r.run "
+                        f"INNER JOIN interfaceanalysis ia on ia.id = tc.analysis "
+                        f"WHERE ia.experiment = %s ")
+        self.cur.execute(SQL(f"SELECT rm.request_id "
+                             f"FROM {self.sql.plugin_schema}.{self.sql.request_match_table} rm "
+                             f"{requests}"
+                             f"AND rm.list_id = %s AND rm.list_version = %s"),
+                         (experiment_id, list_id, list_version))
+        self.conn.commit()
+        return {r[0] for r in self.cur.fetchall()}
 
+    def _save_results(self, filter_list_name: str, list_id: int, list_version: int, requests: list[Request]) -> None:
+        print(f"saving the {filter_list_name} results to the database")
         match_table = f"{self.sql.plugin_schema}.{self.sql.request_match_table}"
-        values = [(r.req_id, list_id, r.match) for r in requests]
-        inserted = execute_values(self.cur,
-                                  SQL(f"INSERT INTO {match_table} (request_id, list_id, match) "
-                                      f"SELECT * FROM (VALUES %s) AS v (rid, lid, result) "
-                                      f"WHERE NOT EXISTS "
-                                      f"( SELECT request_id FROM {match_table} "
-                                      f"  WHERE request_id = v.rid AND list_id = lid) "
-                                      f"RETURNING request_id"),
-                                  values, fetch=True)
+        # load the results into a temporary table with COPY and merge them in a single statement
+        self.cur.execute(SQL(f"CREATE TEMPORARY TABLE IF NOT EXISTS {self.sql.request_match_load_table} ("
+                             f" request_id integer NOT NULL ,"
+                             f" list_id integer NOT NULL ,"
+                             f" match boolean NOT NULL"
+                             f") ON COMMIT DELETE ROWS;"))
+        rows = io.StringIO("".join(f"{r.req_id}\t{list_id}\t{'t' if r.match else 'f'}\n" for r in requests))
+        self.cur.copy_expert(SQL(f"COPY {self.sql.request_match_load_table} (request_id, list_id, match) FROM STDIN"),
+                             rows)
+        self.cur.execute(SQL(f"WITH merged AS ("
+                             f" INSERT INTO {match_table} AS m (request_id, list_id, match, list_version) "
+                             f" SELECT DISTINCT ON (request_id, list_id) request_id, list_id, match, %s "
+                             f" FROM {self.sql.request_match_load_table} "
+                             f" ON CONFLICT (request_id, list_id) DO UPDATE "
+                             f" SET match = EXCLUDED.match, list_version = EXCLUDED.list_version "
+                             f" WHERE m.match != EXCLUDED.match OR m.list_version IS DISTINCT FROM EXCLUDED.list_version "
+                             f" RETURNING (xmax = 0) AS inserted"
+                             f") "
+                             f"SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) "
+                             f"FROM merged"), (list_version,))
+        insert_count, update_count = self.cur.fetchone()
         self.conn.commit()
-        insert_count = len(inserted)
         print(f"{insert_count} rows inserted")
-        updated = execute_values(self.cur,
-                                 SQL(f"UPDATE {match_table} m "
-                                     f"SET match = v.match "
-                                     f"FROM (SELECT * FROM (VALUES %s) AS w (rid, lid, match)) as v "
-                                     f"WHERE m.request_id = v.rid AND m.list_id = v.lid AND m.match != v.match "
-                                     f"RETURNING request_id"),
-                                 values, fetch=True)
-        self.conn.commit()
-        update_count = len(updated)
         print(f"{update_count} rows updated")
+        print(f"{len(requests) - insert_count - update_count} rows unchanged")
 
     def _ensure_schema(self):
         self.cur.execute("SELECT schema_name "
@@ -115,8 +322,13 @@ class AdBlockAddon:
         # create tables if not exist
         self.cur.execute(SQL(f"CREATE TABLE IF NOT EXISTS {self.sql.plugin_schema}.{self.sql.list_name_table} ("
                              f" id integer NOT NULL PRIMARY KEY GENERATED ALWAYS AS IDENTITY ,"
-                             f" name varchar NOT NULL"
+                             f" name varchar NOT NULL ,"
+                             f" content_hash varchar ,"
+                             f" version integer NOT NULL DEFAULT 1"
                              f");"))
+        self.cur.execute(SQL(f"ALTER TABLE {self.sql.plugin_schema}.{self.sql.list_name_table} "
+                             f"ADD COLUMN IF NOT EXISTS content_hash varchar ,"
+                             f"ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1;"))
         self.conn.commit()
 
         self.cur.execute(SQL(f"CREATE TABLE IF NOT EXISTS {self.sql.plugin_schema}.{self.sql.request_match_table} ("
@@ -126,28 +338,82 @@ class AdBlockAddon:
                              f"  REFERENCES {self.sql.plugin_schema}.{self.sql.list_name_table}({'id'})"
                              f"  ON UPDATE CASCADE ON DELETE CASCADE ,"
                              f" match boolean NOT NULL ,"
+                             f" list_version integer ,"
                              f" PRIMARY KEY (request_id, list_id)"
                              f");"))
+        # results written before lists were versioned have no version and count as outdated
+        self.cur.execute(SQL(f"ALTER TABLE {self.sql.plugin_schema}.{self.sql.request_match_table} "
+                             f"ADD COLUMN IF NOT EXISTS list_version integer;"))
         self.conn.commit()
 
-    def _ensure_filter_list(self, filter_list_name: str) -> int:
-        filter_id = self._get_filter_list_id(filter_list_name)
-        if filter_id:
-            assert len(filter_id) == 1
-            return filter_id[0]
-        else:
-            self.cur.execute(SQL(f"INSERT INTO {self.sql.plugin_schema}.{self.sql.list_name_table} (name) "
-                                 f"VALUES (%s)"), (filter_list_name,))
+    def _ensure_filter_list(self, filter_list_name: str, content_hash: str) -> tuple[int, int]:
+        filter_list = self._get_filter_list(filter_list_name)
+        if filter_list is None:
+            self.cur.execute(SQL(f"INSERT INTO {self.sql.plugin_schema}.{self.sql.list_name_table} "
+                                 f"(name, content_hash, version) "
+                                 f"VALUES (%s, %s, 1) RETURNING id"), (filter_list_name, content_hash))
+            list_id = self.cur.fetchone()[0]
             self.conn.commit()
-            return self._get_filter_list_id(filter_list_name)[0]
+            return list_id, 1
+        list_id, known_hash, version = filter_list
+        if known_hash != content_hash:
+            # lists stored before hashing keep their version, their results have none anyway
+            version = version if known_hash is None else version + 1
+            print(f"{filter_list_name} changed, now at version {version}")
+            self.cur.execute(SQL(f"UPDATE {self.sql.plugin_schema}.{self.sql.list_name_table} "
+                                 f"SET content_hash = %s, version = %s "
+                                 f"WHERE id = %s"), (content_hash, version, list_id))
+            self.conn.commit()
+        return list_id, version
 
-    def _get_filter_list_id(self, filter_list_name: str) -> tuple[int]:
-        self.cur.execute(SQL(f"SELECT id "
+    def _get_filter_list(self, filter_list_name: str) -> tuple[int, str | None, int] | None:
+        self.cur.execute(SQL(f"SELECT id, content_hash, version "
                              f"FROM {self.sql.plugin_schema}.{self.sql.list_name_table} fl "
                              f"WHERE fl.name = %s"), (filter_list_name,))
         self.conn.commit()
         return self.cur.fetchone()
 
 
+class MatchRun:
+    # matches the chunks of one experiment against the lists and saves the results chunk by chunk
+    def __init__(self, addon: AdBlockAddon, list_versions: dict[str, tuple[int, int]],
+                 up_to_date: dict[str, set[int]]):
+        self.addon = addon
+        self.list_versions = list_versions
+        self.up_to_date = up_to_date
+        self.stats = {filter_list_name: MatchStats() for filter_list_name in list_versions}
+        self.pool = addon._create_pool() if addon.workers > 1 else None
+
+    def match_chunk(self, chunk: list[Request]) -> set[int]:
+        # the ids of the requests matched by any of the lists
+        matched: set[int] = set()
+        for filter_list_name in self.list_versions:
+            requests = [r for r in chunk if r.req_id not in self.up_to_date[filter_list_name]]
+            if len(requests) == 0:
+                continue
+            urls = group_by_url(requests)
+            print(f"matching {len(requests)} requests ({len(urls)} distinct urls) using {filter_list_name}")
+            cache_hits = self.addon.url_cache.hits
+            with metrics.stage("match"):
+                matches = self.addon.match_urls(filter_list_name, list(urls.keys()), self.pool)
+            for url, url_requests in urls.items():
+                for r in url_requests:
+                    r.match = matches[url]
+                    if r.match:
+                        matched.add(r.req_id)
+            self.stats[filter_list_name].add(requests, len(urls), self.addon.url_cache.hits - cache_hits)
+            with metrics.stage("db_write"):
+                self.addon._save_results(filter_list_name, *self.list_versions[filter_list_name], requests)
+        return matched
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for filter_list_name, list_stats in self.stats.items():
+            print(f"{filter_list_name} {list_stats}")
+
+
 if __name__ == '__main__':
     main()
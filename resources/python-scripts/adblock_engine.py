@@ -0,0 +1,145 @@
+import re
+from collections import Counter
+
+from adblockparser import AdblockRule, AdblockRules
+
+ENGINES = ("adblockparser", "fast")
+TOKEN = re.compile(r"[a-z0-9%]+")
+HOST_RULE = re.compile(r"^\|\|([a-z0-9.-]+)\^$")
+URL_HOST = re.compile(r"^([^:/?#]+)://([^/?#]*)")
+# the characters adblockparser does count as a separator
+SEPARATOR = re.compile(r"[^\w\-.%]")
+# tokens in nearly every url, a rule indexed by them would be checked against almost all urls
+COMMON_TOKENS = {"http", "https", "www", "com", "net", "org", "de", "js", "html", "php", "api", "cdn", "static"}
+
+
+def rule_tokens(rule_text: str) -> list[str] | None:
+    # The tokens every url a rule matches contains as a whole, i.e. literal runs bounded on both sides by
+    # a separator, an anchor or another literal character. None if the rule syntax is not supported.
+    if (rule_text.startswith("/") and rule_text.endswith("/")) or not rule_text.isascii():
+        return None
+    text = rule_text.lower()
+    start = 0
+    anchored_start = False
+    if text.startswith("||") and len(text) > 2:
+        start, anchored_start = 2, True
+    elif text.startswith("|"):
+        start, anchored_start = 1, True
+    end = len(text)
+    anchored_end = False
+    if end > start and text.endswith("|"):
+        end, anchored_end = end - 1, True
+    body = text[start:end]
+    if "|" in body:
+        # adblockparser escapes inner pipes and drops the character following them
+        return None
+    tokens = []
+    for match in TOKEN.finditer(body):
+        before = body[match.start() - 1] if match.start() > 0 else None
+        after = body[match.end()] if match.end() < len(body) else None
+        bounded_before = anchored_start if before is None else before != "*"
+        bounded_after = anchored_end if after is None else after != "*"
+        if bounded_before and bounded_after:
+            tokens.append(match.group())
+    return tokens
+
+
+def url_domains(scheme: str, host: str) -> list[str]:
+    # A ||domain^ rule matches if the domain starts the url, the host or a label of the host and is
+    # followed by a separator, so it is a label suffix of the scheme or of a separator free part of the host.
+    domains = []
+    for part in [scheme.lower()] + SEPARATOR.split(host.lower()):
+        labels = part.split(".")
+        domains += [".".join(labels[i:]) for i in range(len(labels))]
+    return domains
+
+
+class IndexedRule:
+    __slots__ = ("rule", "flags", "_regex")
+
+    def __init__(self, rule: AdblockRule, flags: int):
+        self.rule = rule
+        self.flags = flags
+        self._regex = None
+
+    def matches(self, url: str) -> bool:
+        # compiled on first use, as most rules are never a candidate
+        if self._regex is None:
+            self._regex = re.compile(self.rule.regex, self.flags)
+        return self._regex.search(url) is not None
+
+
+class RuleIndex:
+    # the rules of one kind, i.e. blocking or exception rules, indexed by the host they are anchored to
+    # or by their rarest token, and those that could not be indexed combined into a single regex
+    def __init__(self, basic_rules: list[AdblockRule], match_case_rules: list[AdblockRule]):
+        self.hosts: dict[str, list[IndexedRule]] = dict()
+        self.tokens: dict[str, list[IndexedRule]] = dict()
+        rules = [(rule, re.IGNORECASE) for rule in basic_rules] + [(rule, 0) for rule in match_case_rules]
+        tokenized = [(rule, flags, rule_tokens(rule.rule_text)) for rule, flags in rules]
+        frequency = Counter(token for _, _, tokens in tokenized if tokens is not None for token in set(tokens))
+        unindexed: list[AdblockRule] = []
+        self.unindexed_match_case: list[IndexedRule] = []
+        for rule, flags, tokens in tokenized:
+            host = HOST_RULE.match(rule.rule_text.lower())
+            if host is not None:
+                self.hosts.setdefault(host.group(1), []).append(IndexedRule(rule, flags))
+                continue
+            candidates = [t for t in tokens or [] if t not in COMMON_TOKENS]
+            if len(candidates) > 0:
+                token = min(candidates, key=lambda t: (frequency[t], -len(t)))
+                self.tokens.setdefault(token, []).append(IndexedRule(rule, flags))
+            elif flags == 0:
+                self.unindexed_match_case.append(IndexedRule(rule, flags))
+            else:
+                unindexed.append(rule)
+        joined = "|".join(rule.regex for rule in unindexed if rule.regex)
+        self.unindexed = re.compile(joined, re.IGNORECASE) if joined else None
+        self.size = len(rules)
+        self.unindexed_size = len(unindexed) + len(self.unindexed_match_case)
+
+    def matches(self, url: str, domains: list[str]) -> bool:
+        for domain in domains:
+            for rule in self.hosts.get(domain, ()):
+                if rule.matches(url):
+                    return True
+        for token in set(TOKEN.findall(url.lower())):
+            for rule in self.tokens.get(token, ()):
+                if rule.matches(url):
+                    return True
+        if self.unindexed is not None and self.unindexed.search(url) is not None:
+            return True
+        return any(rule.matches(url) for rule in self.unindexed_match_case)
+
+
+class FastRules:
+    # Matches urls like AdblockRules.should_block without options, but checks every url only against the
+    # rules anchored to one of its parent domains or containing one of its tokens. The rules adblockparser
+    # would evaluate without options are taken from the given AdblockRules, which also handles all urls
+    # that are not plain ascii urls with a host.
+    def __init__(self, rules: AdblockRules):
+        self.fallback = rules
+        match_case = [r for r in rules.blacklist_with_options + rules.whitelist_with_options
+                      if r.matching_supported({})]
+        self.blacklist = RuleIndex(rules.blacklist, [r for r in match_case if not r.is_exception])
+        self.whitelist = RuleIndex(rules.whitelist, [r for r in match_case if r.is_exception])
+        self.fallbacks = 0
+
+    def should_block(self, url: str) -> bool:
+        head = URL_HOST.match(url) if url.isascii() else None
+        if head is None:
+            self.fallbacks += 1
+            return self.fallback.should_block(url)
+        domains = url_domains(head.group(1), head.group(2))
+        if self.whitelist.matches(url, domains):
+            return False
+        return self.blacklist.matches(url, domains)
+
+    def __str__(self):
+        indexed = self.blacklist.size + self.whitelist.size
+        unindexed = self.blacklist.unindexed_size + self.whitelist.unindexed_size
+        return f"fast rules: {indexed - unindexed} of {indexed} rules indexed"
+
+
+def create_matcher(rules: AdblockRules, engine: str) -> AdblockRules | FastRules:
+    return FastRules(rules) if engine == "fast" else rules
@@ -0,0 +1,483 @@
+import argparse
+import contextlib
+import gc
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import accumulate
+from pathlib import Path
+from typing import Iterator
+
+# imported before the pipeline modules, which create their progress bars at call time
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+import llm_traffic_analysis
+from adblock_addon import FILTER_LIST_DIR, AdBlockAddon
+from adblock_engine import ENGINES, FastRules
+from llm import gpt4, parse_private_data
+from llm_traffic_analysis import match_modes
+from pipeline import Pipeline
+from private_data import PrivateData, deduplicate_private_data
+from request import NormalizedRequest, Request
+from rule_cache import load_rules
+
+SIZES = "10k,100k,1M"
+SEED = 1
+DUPLICATION = 0.6
+HOSTS = 2_000
+LLM_BATCH_SIZE = 200
+# requests matched with adblockparser, the fast engine matches all of them by default
+MATCH_LIMIT = 2_000
+COMPARE_URLS = 500
+STUB_LATENCY = 0.05
+# the payloads of a packed prompt, see llm.packed_completion_arguments
+PACKED_PAYLOAD = re.compile(r"<<<payload (\d+)>>>\n(.*?)\n<<<end \1>>>", re.DOTALL)
+RESULTS_DIR = Path(__file__).with_name("benchmark_results")
+SOURCE = "benchmark"
+
+PATHS = ["/v1/events", "/api/track", "/collect", "/log", "/sdk/init", "/config", "/ads/request", "/e", "/batch"]
+KEYS = ["os", "osv", "model", "lang", "tz", "ua", "carrier", "w", "h", "rooted", "battery", "appid",
+        "appversion", "sdkversion", "lat", "lon", "ip", "country", "screen",
+        "id", "ts", "event", "session", "seq", "payload", "uid", "adid", "hash", "flags", "ext"]
+VALUES = ["android", "13", "Pixel 7", "de-DE", "Europe/Berlin", "Mozilla/5.0", "Vodafone", "1080", "2400",
+          "false", "87", "org.example.app", "1.4.2", "21.3.0", "52.52", "13.40", "10.0.0.1", "DE", "MainActivity"]
+
+
+def parse_size(size: str) -> int:
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(size[-1].lower(), 1)
+    return int(size[:-1] if multiplier > 1 else size) * multiplier
+
+
+def content_digest(content: str) -> str:
+    # the digest the experiment queries compute in sql, length and md5 of the content
+    return f"{len(content)}:{hashlib.md5(content.encode('utf-8')).hexdigest()}"
+
+
+def generate_corpus(size: int, seed: int = SEED, duplication: float = DUPLICATION,
+                    host_count: int = HOSTS) -> list[tuple[int, str, str, str, str]]:
+    # rows of (id, scheme, host, path, content) with zipf distributed hosts, query strings,
+    # json bodies and the given share of requests repeating the values of an earlier one
+    rng = random.Random(seed)
+    hosts = [f"{rng.choice(['api', 'sdk', 'log', 'ads', 't'])}{i}.{rng.choice(['tracker', 'cdn', 'metrics'])}.com"
+             for i in range(host_count)]
+    cum_weights = list(accumulate(1 / (i + 1) ** 1.1 for i in range(host_count)))
+    rows: list[tuple[int, str, str, str, str]] = []
+    for request_id in range(1, size + 1):
+        if len(rows) > 0 and rng.random() < duplication:
+            _, scheme, host, path, content = rows[rng.randrange(len(rows))]
+            rows.append((request_id, scheme, host, path, content))
+            continue
+        host = rng.choices(hosts, cum_weights=cum_weights)[0]
+        path = rng.choice(PATHS)
+        if rng.random() < 0.5:
+            path += "?" + "&".join(f"{k}={rng.choice(VALUES)}" for k in rng.sample(KEYS, rng.randint(1, 6)))
+        content = ""
+        if rng.random() < 0.6:
+            body = {k: rng.choice(VALUES) for k in rng.sample(KEYS, rng.randint(2, 12))}
+            body["ts"] = rng.randrange(1_600_000_000, 1_700_000_000)
+            content = json.dumps(body)
+        rows.append((request_id, "https" if rng.random() < 0.95 else "http", host, path, content))
+    return rows
+
+
+class MemoryWriter:
+    def __init__(self, db: "MemoryDatabase"):
+        self.db = db
+
+    def add(self, request: Request, private_data: list[PrivateData], source: str, model: str,
+            dequeue: bool = False) -> None:
+        self.db.private_data[request.req_id] = private_data
+        self.db.analyzed.add(request.req_id)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryDatabase:
+    # stands in for database.Database, serving a corpus from memory and keeping what is written
+    def __init__(self, rows: list[tuple[int, str, str, str, str]]):
+        self.rows = rows
+        self.contents = {r[0]: r[4] for r in rows}
+        self.normalized: list[NormalizedRequest] = []
+        self.private_data: dict[int, list[PrivateData]] = dict()
+        self.analyzed: set[int] = set()
+        self.checkpoints: set[tuple[str, str]] = set()
+
+    def stream_experiment_requests(self, experiment_id: int) -> Iterator[Request]:
+        for r in self.rows:
+            yield Request(r[0], r[1], r[2], r[3], content_digest=content_digest(r[4]))
+
+    stream_experiment_matched_requests = stream_experiment_requests
+
+    def get_experiment_app_requests(self, experiment_id: int, only_apps: list[str]) -> list[Request]:
+        return list(self.stream_experiment_requests(experiment_id))
+
+    def stream_experiment_pipeline_requests(self, experiment_id: int, chunk_size: int | None = None
+                                            ) -> Iterator[list[tuple[Request, str, bool]]]:
+        chunk_size = len(self.rows) if chunk_size is None else chunk_size
+        for start in range(0, len(self.rows), max(chunk_size, 1)):
+            yield [(Request(r[0], r[1], r[2], r[3], content_digest=content_digest(r[4])), SOURCE, True)
+                   for r in self.rows[start:start + chunk_size]]
+
+    def get_experiment_matched_request_ids(self, experiment_id: int) -> set[int]:
+        return set()
+
+    def get_pipeline_checkpoints(self, experiment_id: int) -> set[tuple[str, str]]:
+        return set(self.checkpoints)
+
+    def set_pipeline_checkpoint(self, experiment_id: int, stage: str, config: str) -> None:
+        self.checkpoints.add((stage, config))
+
+    def load_contents(self, requests: list[Request]) -> None:
+        for r in requests:
+            if not r.content_loaded:
+                r.load_content(self.contents[r.req_id])
+
+    def insert_normalized_requests(self, normalized_requests: list[NormalizedRequest]) -> bool:
+        self.normalized += normalized_requests
+        return True
+
+    def get_normalized_request_ids_analyzed(self, source: str, model: str) -> list[int]:
+        return list(self.analyzed)
+
+    def buffered_writer(self, *args) -> MemoryWriter:
+        return MemoryWriter(self)
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryAdBlockAddon(AdBlockAddon):
+    # matches against the real filter lists but keeps requests and results in memory
+    def __init__(self, filter_list_names: list[str], rows: list[tuple[int, str, str, str, str]],
+                 engine: str = ENGINES[0]):
+        super().__init__(filter_list_names, engine=engine)
+        self.rows = rows
+        self.saved = 0
+
+    def _ensure_schema(self):
+        pass
+
+    def _ensure_filter_list(self, filter_list_name: str, content_hash: str) -> tuple[int, int]:
+        return 1, 1
+
+    def _get_existing_matches(self, experiment_id: int, list_id: int, list_version: int) -> set[int]:
+        return set()
+
+    def _get_experiment_requests(self, experiment_id: int) -> list[Request]:
+        return [Request(r[0], r[1], r[2], r[3]) for r in self.rows]
+
+    def _save_results(self, filter_list_name: str, list_id: int, list_version: int, requests: list[Request]) -> None:
+        self.saved += len(requests)
+
+
+class StubCompletions(BaseHTTPRequestHandler):
+    # answers every chat completion with a few lines of private data after a fixed latency
+    latency = STUB_LATENCY
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.complete(body)
+
+    def complete(self, body: dict) -> None:
+        time.sleep(self.latency)
+        prompt = body["messages"][-1]["content"]
+        payloads = PACKED_PAYLOAD.findall(prompt)
+        if len(payloads) > 0:
+            # the end markers are echoed, as models often do
+            answer = "\n".join(f"<<<payload {i}>>>\n{self.answer(payload)}\n<<<end {i}>>>" for i, payload in payloads)
+        else:
+            answer = "\n".join(["Data Category,Key,Value", self.answer(prompt)])
+        self.send_json(200, {"id": "benchmark", "object": "chat.completion", "created": 0, "model": body["model"],
+                             "choices": [{"index": 0, "finish_reason": "stop",
+                                          "message": {"role": "assistant", "content": answer}}],
+                             "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 20,
+                                       "total_tokens": len(prompt) // 4 + 20}})
+
+    @staticmethod
+    def answer(prompt: str) -> str:
+        return "\n".join(["OS,os,android", "Language,lang,de-DE", f"Model,model,{prompt[:8].replace(',', ' ')}"])
+
+    def send_json(self, status: int, payload: dict, headers: dict[str, str] | None = None) -> None:
+        response = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency: float, handler: type[StubCompletions] = StubCompletions) -> ThreadingHTTPServer:
+    handler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    return server
+
+
+class Stages:
+    def __init__(self):
+        self.seconds: dict[str, float] = dict()
+
+    @contextlib.contextmanager
+    def time(self, name: str):
+        # the pipeline reports every request on stdout, which would dominate the timings
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+        self.seconds[name] = round(time.perf_counter() - start, 4)
+        print(f"  {name}: {self.seconds[name]:.3f}s", file=sys.stderr)
+
+
+def run_size(size: int, args: argparse.Namespace) -> dict:
+    stages = Stages()
+    if args.postgres is None:
+        with stages.time("generate"):
+            rows = generate_corpus(size, args.seed, args.duplication, args.hosts)
+    else:
+        from database import Database
+        postgres = Database()
+        with stages.time("fetch_postgres"):
+            rows = [(r.req_id, r.scheme, r.host, r.path, "") for r in postgres.stream_experiment_requests(args.postgres)]
+        with stages.time("load_contents_postgres"):
+            requests = [Request(r[0], r[1], r[2], r[3], content_digest="") for r in rows]
+            postgres.load_contents(requests)
+        rows = [(r.req_id, r.scheme, r.host, r.path, r.content) for r in requests]
+        postgres.close()
+    db = MemoryDatabase(rows)
+    llm_traffic_analysis.db = db
+
+    with stages.time("stream"):
+        requests = list(db.stream_experiment_requests(0))
+    with stages.time("normalize"):
+        normalized_requests = llm_traffic_analysis.normalize_requests(requests)
+    with stages.time("save_normalized"):
+        llm_traffic_analysis.save_normalized_requests(normalized_requests)
+    normals = list(normalized_requests.keys())
+    with stages.time("remaining"):
+        remaining = llm_traffic_analysis.get_normals_to_analyze(normals, SOURCE, gpt4)
+    batch = remaining[:args.llm_batch]
+    with stages.time("load_contents"):
+        db.load_contents(batch)
+    llm_config = llm_traffic_analysis.LLMConfig(gpt4, SOURCE, args.concurrency)
+    with stages.time("llm"):
+        llm_traffic_analysis.analyze_batch(batch, llm_config, db.buffered_writer())
+
+    rng = random.Random(args.seed)
+    answer = "\n".join(f"{rng.choice(['OS', 'Model', 'Language'])},{rng.choice(KEYS)},{rng.choice(VALUES)}"
+                       for _ in range(max(size // 10, 1)))
+    with stages.time("parse_answer"):
+        private_data = parse_private_data(answer, SOURCE, gpt4)
+    with stages.time("deduplicate"):
+        deduplicate_private_data(private_data)
+
+    match_limit = args.match_limit
+    if match_limit is None:
+        match_limit = len(rows) if args.engine == "fast" else MATCH_LIMIT
+    match_rows = rows[:match_limit]
+    if len(match_rows) > 0 and args.filter_list != "none":
+        with stages.time("load_rules"):
+            addon = MemoryAdBlockAddon([args.filter_list], match_rows, args.engine)
+        with stages.time("match"):
+            addon.match_requests(0)
+        # the adblock and normalize stages on the same requests from a single fetch, without the
+        # urls cached by the match stage
+        addon.url_cache.clear()
+        with stages.time("pipeline"):
+            Pipeline(MemoryDatabase(match_rows), ["adblock", "normalize"], addon, match_modes[1], []).run(0)
+
+    return {"size": size, "requests": len(rows), "normals": len(normals), "llm_batch": len(batch),
+            "answer_pairs": len(private_data), "matched_requests": len(match_rows),
+            "match_capped": len(match_rows) < len(rows),
+            "seconds": stages.seconds, "max_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)}
+
+
+def unslotted(cls: type) -> type:
+    # the same record with an instance dict instead of slots, as the records were before
+    namespace = {name: value for name, value in vars(cls).items() if name != "__slots__" and name not in cls.__slots__}
+    return type(cls.__name__, (), namespace)
+
+
+def rss_mib() -> float:
+    # the current resident set size, or the peak where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_slots_memory(size: int, slotted: bool, args: argparse.Namespace) -> dict:
+    # builds size requests with content digests and size private data. The inputs are created and kept
+    # before measuring, so no freed memory is reused and the rss growth is that of the records only.
+    request_class, private_data_class = (Request, PrivateData) if slotted \
+        else (unslotted(Request), unslotted(PrivateData))
+    rows = generate_corpus(size, args.seed, args.duplication, args.hosts)
+    digests = [content_digest(r[4]) for r in rows]
+    rng = random.Random(args.seed)
+    pairs = [(rng.choice(["OS", "Model", "Language"]), rng.choice(KEYS), rng.choice(VALUES)) for _ in range(size)]
+    gc.collect()
+    stages = Stages()
+    before = rss_mib()
+    with stages.time("requests"):
+        requests = [request_class(r[0], r[1], r[2], r[3], content_digest=digest) for r, digest in zip(rows, digests)]
+    after_requests = rss_mib()
+    with stages.time("private_data"):
+        private_data = [private_data_class(category, key, value, SOURCE, gpt4) for category, key, value in pairs]
+    after = rss_mib()
+    return {"size": size, "slots": slotted, "records": len(requests) + len(private_data), "seconds": stages.seconds,
+            "requests_rss_mib": round(after_requests - before, 1),
+            "private_data_rss_mib": round(after - after_requests, 1),
+            "max_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)}
+
+
+def rule_urls(rules, count: int, seed: int) -> list[str]:
+    # urls derived from the rules themselves, as hardly any synthetic url is blocked by a real list
+    rng = random.Random(seed)
+    texts = [rule.rule_text for rule in rules.blacklist + rules.whitelist]
+    urls = []
+    for text in rng.sample(texts, min(count, len(texts))):
+        text = text.strip("|").replace("*", "x").replace("^", "/")
+        urls.append(f"https://example.com{text}" if text.startswith("/") else f"https://{text}")
+        urls.append(f"https://sub.{text.split('/')[0]}/path?q=1")
+    return urls
+
+
+def compare_engines(filter_list_names: list[str], args: argparse.Namespace) -> list[dict]:
+    # matches the same urls with both engines, every difference in the results is a bug of the fast engine
+    corpus = [f"{r[1]}://{r[2]}{r[3]}" for r in generate_corpus(args.compare_urls, args.seed, args.duplication,
+                                                                 args.hosts)]
+    results = []
+    for filter_list_name in filter_list_names:
+        try:
+            rules, _ = load_rules(FILTER_LIST_DIR / f"{filter_list_name}.txt")
+        except re.error as e:
+            # as in AdBlockAddon, lists adblockparser cannot compile are left out
+            print(f"  {filter_list_name}: skipped, its rules cannot be compiled: {e}", file=sys.stderr)
+            results.append({"filter_list": filter_list_name, "skipped": str(e), "mismatch_count": 0})
+            continue
+        start = time.perf_counter()
+        fast = FastRules(rules)
+        build_seconds = time.perf_counter() - start
+        urls = list(dict.fromkeys(corpus + rule_urls(rules, args.compare_urls, args.seed)))
+        seconds = dict()
+        matches = dict()
+        for engine, matcher in (("adblockparser", rules), ("fast", fast)):
+            start = time.perf_counter()
+            matches[engine] = [matcher.should_block(url) for url in urls]
+            seconds[engine] = round(time.perf_counter() - start, 4)
+        mismatches = [url for url, expected, actual in zip(urls, matches["adblockparser"], matches["fast"])
+                      if expected != actual]
+        print(f"  {filter_list_name}: {len(urls)} urls, {sum(matches['adblockparser'])} blocked, "
+              f"{seconds['adblockparser']:.3f}s vs {seconds['fast']:.3f}s, {len(mismatches)} mismatches, {fast}",
+              file=sys.stderr)
+        results.append({"filter_list": filter_list_name, "urls": len(urls), "blocked": sum(matches["adblockparser"]),
+                        "build_seconds": round(build_seconds, 4), "seconds": seconds,
+                        "speedup": round(seconds["adblockparser"] / max(seconds["fast"], 1e-4), 1),
+                        "fallbacks": fast.fallbacks, "mismatches": mismatches[:20],
+                        "mismatch_count": len(mismatches)})
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time the pipeline stages on synthetic request corpora")
+    parser.add_argument("--sizes", default=SIZES, help="comma separated corpus sizes, e.g. 10k,100k,1M")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--duplication", type=float, default=DUPLICATION,
+                        help="share of requests repeating the values of an earlier request")
+    parser.add_argument("--hosts", type=int, default=HOSTS, help="number of distinct hosts")
+    parser.add_argument("--llm-batch", type=int, default=LLM_BATCH_SIZE,
+                        help="number of normals sent to the stub completions server")
+    parser.add_argument("--concurrency", type=int, default=1, help="concurrent llm requests")
+    parser.add_argument("--stub-latency", type=float, default=STUB_LATENCY,
+                        help="seconds the stub completions server takes per answer")
+    parser.add_argument("--filter-list", default=None, help="filter list to match with or 'none', easyprivacy by default")
+    parser.add_argument("--engine", choices=ENGINES, default=ENGINES[0], help="engine of the match stage")
+    parser.add_argument("--compare-engines", action="store_true",
+                        help="only compare the results and timings of the matching engines on every filter list, "
+                             "or on --filter-list if given")
+    parser.add_argument("--compare-urls", type=int, default=COMPARE_URLS,
+                        help="number of synthetic and of rule derived urls matched per list when comparing")
+    parser.add_argument("--slots-memory", action="store_true",
+                        help="only measure the rss and build time of --sizes requests and private data, "
+                             "with and without __slots__")
+    parser.add_argument("--match-limit", type=int, default=None,
+                        help=f"number of requests matched against the filter list, by default all of them with "
+                             f"the fast engine and {MATCH_LIMIT} with adblockparser")
+    parser.add_argument("--postgres", type=int, default=None, metavar="EXPERIMENT_ID",
+                        help="fetch the requests of an experiment from postgres instead of generating them")
+    parser.add_argument("--output", type=Path, default=None, help="result file, by default in benchmark_results")
+    args = parser.parse_args()
+
+    started = datetime.now(timezone.utc)
+    if args.slots_memory:
+        results = []
+        context = multiprocessing.get_context("fork")
+        for size in [parse_size(size) for size in args.sizes.split(",")]:
+            for slotted in (False, True):
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_slots_memory, (size, slotted, args))
+                print(f"  {size} {'with' if slotted else 'without'} slots: requests {result['requests_rss_mib']} MiB, "
+                      f"private data {result['private_data_rss_mib']} MiB", file=sys.stderr)
+                results.append(result)
+    elif args.compare_engines:
+        names = [args.filter_list] if args.filter_list is not None \
+            else sorted(p.stem for p in FILTER_LIST_DIR.glob("*.txt"))
+        print(f"comparing the matching engines on {len(names)} filter lists", file=sys.stderr)
+        results = compare_engines(names, args)
+    else:
+        if args.filter_list is None:
+            args.filter_list = "easyprivacy"
+        server = start_stub_server(args.stub_latency)
+        sizes = [parse_size(size) for size in args.sizes.split(",")] if args.postgres is None else [0]
+        results = []
+        # every size runs in a fresh process, so the peak rss is its own
+        context = multiprocessing.get_context("fork")
+        for size in sizes:
+            print(f"benchmarking {size if args.postgres is None else f'experiment {args.postgres}'}", file=sys.stderr)
+            with context.Pool(1) as pool:
+                results.append(pool.apply(run_size, (size, args)))
+        server.shutdown()
+
+    report = {"started": started.isoformat(), "commit": git_commit(), "python": platform.python_version(),
+              "machine": platform.machine(), "cpus": os.cpu_count(),
+              "arguments": {k: str(v) for k, v in vars(args).items()}, "results": results}
+    output = args.output or RESULTS_DIR / f"{started.strftime('%Y%m%dT%H%M%S')}-{report['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"results written to {output}")
+    if args.compare_engines and any(r["mismatch_count"] > 0 for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
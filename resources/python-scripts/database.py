@@ -1,58 +1,139 @@
-import os
+import atexit
+import signal
+import sys
+import threading
+import time
 import types
+from typing import Iterator
 
 import psycopg2
 from psycopg2 import sql
 from psycopg2.extras import execute_values
 from psycopg2.sql import SQL
 
+import experiment_view
+import metrics
+from db_pool import PooledSession
+from experiment_view import REQUEST_TABLE
 from private_data import PrivateData
 from request import NormalizedRequest
 from request import Request
 
+STREAM_ITERSIZE = 10_000
+CONTENT_BATCH_SIZE = 500
+FLUSH_REQUESTS = 50
+FLUSH_SECONDS = 30.0
+# the content is only fetched for the normalized requests that are analyzed, see load_contents
+CONTENT_DIGEST = "length(coalesce(r.content, '')) || ':' || md5(coalesce(r.content, ''))"
+EXPERIMENT_REQUESTS_QUERY = ("SELECT r.id, r.scheme, r.host, r.path, "
+                             f"{CONTENT_DIGEST} "
+                             "FROM interfaceanalysis ia "
+                             "INNER JOIN trafficcollection tc on tc.analysis = ia.id "
+                             "INNER JOIN request r on r.run = tc.id "
+                             "WHERE ia.experiment = %s "
+                             "AND r.error IS Null "
+                             "AND ia.success IS true;")
+EXPERIMENT_MATCHED_REQUESTS_QUERY = ("SELECT DISTINCT r.id, r.scheme, r.host, r.path, "
+                                     f"{CONTENT_DIGEST} "
+                                     "FROM interfaceanalysis ia "
+                                     "INNER JOIN trafficcollection tc on tc.analysis = ia.id "
+                                     "INNER JOIN request r on r.run = tc.id "
+                                     "INNER JOIN pluginadblock.requestmatch rm on rm.request_id = r.id "
+                                     "WHERE ia.experiment = %s "
+                                     "AND r.error IS Null "
+                                     "AND ia.success IS true "
+                                     "AND rm.match IS true;")
+# every request of an experiment, as matched by the adblock addon, with the app and whether the llm analysis
+# covers it. The content digest is only computed for the requests the llm analysis covers.
+EXPERIMENT_PIPELINE_REQUESTS_QUERY = ("SELECT r.id, r.scheme, r.host, r.path, "
+                                      f"CASE WHEN r.error IS Null AND ia.success IS true THEN {CONTENT_DIGEST} END, "
+                                      "ia.app_id "
+                                      "FROM interfaceanalysis ia "
+                                      "INNER JOIN trafficcollection tc on tc.analysis = ia.id "
+                                      "INNER JOIN request r on r.run = tc.id "
+                                      "WHERE ia.experiment = %s;")
+EXPERIMENT_MATCHED_REQUEST_IDS_QUERY = ("SELECT DISTINCT rm.request_id "
+                                        "FROM interfaceanalysis ia "
+                                        "INNER JOIN trafficcollection tc on tc.analysis = ia.id "
+                                        "INNER JOIN request r on r.run = tc.id "
+                                        "INNER JOIN pluginadblock.requestmatch rm on rm.request_id = r.id "
+                                        "WHERE ia.experiment = %s "
+                                        "AND rm.match IS true;")
+# the same queries on the materialized experiment requests, see experiment_view
+VIEW_REQUESTS_QUERY = ("SELECT er.request_id, er.scheme, er.host, er.path, er.content_digest "
+                       f"FROM {REQUEST_TABLE} er "
+                       "WHERE er.experiment = %s "
+                       "AND er.analyzable;")
+VIEW_MATCHED_REQUESTS_QUERY = ("SELECT DISTINCT er.request_id, er.scheme, er.host, er.path, er.content_digest "
+                               f"FROM {REQUEST_TABLE} er "
+                               "INNER JOIN pluginadblock.requestmatch rm on rm.request_id = er.request_id "
+                               "WHERE er.experiment = %s "
+                               "AND er.analyzable "
+                               "AND rm.match IS true;")
+VIEW_PIPELINE_REQUESTS_QUERY = ("SELECT er.request_id, er.scheme, er.host, er.path, "
+                                "CASE WHEN er.analyzable THEN er.content_digest END, er.app_id "
+                                f"FROM {REQUEST_TABLE} er "
+                                "WHERE er.experiment = %s;")
+VIEW_MATCHED_REQUEST_IDS_QUERY = ("SELECT DISTINCT rm.request_id "
+                                  f"FROM {REQUEST_TABLE} er "
+                                  "INNER JOIN pluginadblock.requestmatch rm on rm.request_id = er.request_id "
+                                  "WHERE er.experiment = %s "
+                                  "AND rm.match IS true;")
 
-class Database:
+
+class Database(PooledSession):
     def __init__(self):
+        super().__init__()
         self.sql = types.SimpleNamespace()
-        self.conn = psycopg2.connect(host=os.environ['POSTGRES_HOST'] or 'localhost', port=os.environ['HOST_PORT'],
-                                     dbname=os.environ['POSTGRES_DB'], user=os.environ['POSTGRES_USER'],
-                                     password=os.environ['POSTGRES_PASSWORD'])
-        self.cur = self.conn.cursor()
+
+    def _experiment_query(self, experiment_id: int, query: str, view_query: str) -> str:
+        return view_query if experiment_view.is_current(self.cur, experiment_id) else query
 
     def _get_requests(self, query: str, params) -> list[Request]:
         self.cur.execute(query, params)
         self.conn.commit()
-        return [Request(r[0], r[1], r[2], r[3], r[4]) for r in self.cur.fetchall()]
+        return [Request(r[0], r[1], r[2], r[3], content_digest=r[4]) for r in self.cur.fetchall()]
+
+    def _stream_requests(self, query: str, params, itersize: int) -> Iterator[Request]:
+        cur = self.conn.cursor(name="stream_requests")
+        cur.itersize = itersize
+        try:
+            cur.execute(query, params)
+            for r in cur:
+                yield Request(r[0], r[1], r[2], r[3], content_digest=r[4])
+        finally:
+            cur.close()
+            self.conn.commit()
 
     def get_experiment_requests(self, experiment_id: int) -> list[Request]:
-        self.cur.execute("SELECT r.id, r.scheme, r.host, r.path, r.content "
-                         "FROM interfaceanalysis ia "
-                         "INNER JOIN trafficcollection tc on tc.analysis = ia.id "
-                         "INNER JOIN request r on r.run = tc.id "
-                         "WHERE ia.experiment = %s "
-                         "AND r.error IS Null "
-                         "AND ia.success IS true;",
-                         (experiment_id,))
-        self.conn.commit()
-        return [Request(r[0], r[1], r[2], r[3], r[4]) for r in self.cur.fetchall()]
+        query = self._experiment_query(experiment_id, EXPERIMENT_REQUESTS_QUERY, VIEW_REQUESTS_QUERY)
+        return self._get_requests(query, (experiment_id,))
+
+    def stream_experiment_requests(self, experiment_id: int, itersize: int = STREAM_ITERSIZE) -> Iterator[Request]:
+        query = self._experiment_query(experiment_id, EXPERIMENT_REQUESTS_QUERY, VIEW_REQUESTS_QUERY)
+        return self._stream_requests(query, (experiment_id,), itersize)
 
     def get_experiment_matched_requests(self, experiment_id: int) -> list[Request]:
-        self.cur.execute("SELECT DISTINCT r.id, r.scheme, r.host, r.path, r.content "
-                         "FROM interfaceanalysis ia "
-                         "INNER JOIN trafficcollection tc on tc.analysis = ia.id "
-                         "INNER JOIN request r on r.run = tc.id "
-                         "INNER JOIN pluginadblock.requestmatch rm on rm.request_id = r.id "
-                         "WHERE ia.experiment = %s "
-                         "AND r.error IS Null "
-                         "AND ia.success IS true "
-                         "AND rm.match IS true;",
-                         (experiment_id,))
-        self.conn.commit()
-        return [Request(r[0], r[1], r[2], r[3], r[4]) for r in self.cur.fetchall()]
+        query = self._experiment_query(experiment_id, EXPERIMENT_MATCHED_REQUESTS_QUERY, VIEW_MATCHED_REQUESTS_QUERY)
+        return self._get_requests(query, (experiment_id,))
+
+    def stream_experiment_matched_requests(self, experiment_id: int,
+                                           itersize: int = STREAM_ITERSIZE) -> Iterator[Request]:
+        query = self._experiment_query(experiment_id, EXPERIMENT_MATCHED_REQUESTS_QUERY, VIEW_MATCHED_REQUESTS_QUERY)
+        return self._stream_requests(query, (experiment_id,), itersize)
 
     def get_experiment_app_requests(self, experiment_id: int, only_apps: list[str]) -> list[Request]:
         values = [sql.Literal(app_id) for app_id in only_apps]
-        query = (SQL("""SELECT DISTINCT r.id, r.scheme, r.host, r.path, r.content 
+        if experiment_view.is_current(self.cur, experiment_id):
+            return self._get_requests(SQL("SELECT DISTINCT er.request_id, er.scheme, er.host, er.path, "
+                                          "er.content_digest "
+                                          "FROM {table} er "
+                                          "WHERE er.experiment = {experiment} "
+                                          "AND er.analyzable "
+                                          "AND er.app_id IN ({apps});")
+                                      .format(table=SQL(REQUEST_TABLE), experiment=sql.Literal(experiment_id),
+                                              apps=SQL(', ').join(values)), None)
+        query = (SQL("""SELECT DISTINCT r.id, r.scheme, r.host, r.path, {content_digest}
                     FROM interfaceanalysis ia 
                     INNER JOIN trafficcollection tc on tc.analysis = ia.id 
                     INNER JOIN request r on r.run = tc.id 
@@ -60,10 +141,50 @@ class Database:
                     AND r.error IS Null 
                     AND ia.success IS true 
                     AND ia.app_id IN ({apps});""")
-                 .format(experiment=sql.Literal(experiment_id), apps=SQL(', ').join(values)))
+                 .format(content_digest=SQL(CONTENT_DIGEST), experiment=sql.Literal(experiment_id),
+                         apps=SQL(', ').join(values)))
         self.cur.execute(query)
         requests = self.cur.fetchall()
-        return [Request(r[0], r[1], r[2], r[3], r[4]) for r in requests]
+        return [Request(r[0], r[1], r[2], r[3], content_digest=r[4]) for r in requests]
+
+    def stream_experiment_pipeline_requests(self, experiment_id: int, chunk_size: int | None = None
+                                            ) -> Iterator[list[tuple[Request, str, bool]]]:
+        # chunks of (request, app id, analyzable), all in one chunk without a chunk size. Requests that are
+        # not analyzable, i.e. failed or of a failed analysis, have no content digest and are only matched.
+        query = self._experiment_query(experiment_id, EXPERIMENT_PIPELINE_REQUESTS_QUERY, VIEW_PIPELINE_REQUESTS_QUERY)
+        if chunk_size is None:
+            self.cur.execute(query, (experiment_id,))
+            self.conn.commit()
+            yield [_pipeline_row(r) for r in self.cur.fetchall()]
+            return
+        cur = self.conn.cursor(name=f"pipeline_requests_{experiment_id}")
+        cur.itersize = chunk_size
+        try:
+            cur.execute(query, (experiment_id,))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [_pipeline_row(r) for r in rows]
+        finally:
+            cur.close()
+            self.conn.commit()
+
+    def get_experiment_matched_request_ids(self, experiment_id: int) -> set[int]:
+        query = self._experiment_query(experiment_id, EXPERIMENT_MATCHED_REQUEST_IDS_QUERY,
+                                       VIEW_MATCHED_REQUEST_IDS_QUERY)
+        self.cur.execute(query, (experiment_id,))
+        self.conn.commit()
+        return {r[0] for r in self.cur.fetchall()}
+
+    def load_contents(self, requests: list[Request], batch_size: int = CONTENT_BATCH_SIZE) -> None:
+        pending = [r for r in requests if not r.content_loaded]
+        for start in range(0, len(pending), batch_size):
+            batch = {r.req_id: r for r in pending[start:start + batch_size]}
+            self.cur.execute("SELECT r.id, r.content FROM request r WHERE r.id = ANY(%s);", (list(batch.keys()),))
+            for request_id, content in self.cur.fetchall():
+                batch[request_id].load_content(content)
+            self.conn.commit()
 
     def insert_normalized_requests(self, normalized_requests: list[NormalizedRequest]) -> bool:
         values = [(r.request_id, r.normalized_id) for r in normalized_requests]
@@ -97,6 +218,64 @@ class Database:
         self.conn.commit()
         return len(inserted) == len(values)
 
+    def ensure_llm_queue(self) -> None:
+        # the queue only holds work every worker enqueues again on start, so a queue from before it was
+        # keyed by the experiment and app selection is replaced
+        self.cur.execute("SELECT 1 FROM information_schema.columns "
+                         "WHERE table_schema = 'pluginadblock' AND table_name = 'request_llm_queue' "
+                         "  AND column_name = 'experiment';")
+        if self.cur.fetchone() is None:
+            self.cur.execute("DROP TABLE IF EXISTS pluginadblock.request_llm_queue;")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS pluginadblock.request_llm_queue ("
+                         " experiment integer NOT NULL ,"
+                         " selection varchar NOT NULL ,"
+                         " request_id integer NOT NULL REFERENCES public.request(id) "
+                         "  ON UPDATE CASCADE ON DELETE CASCADE ,"
+                         " source varchar NOT NULL ,"
+                         " model varchar NOT NULL ,"
+                         " claimed_by varchar ,"
+                         " lease_until timestamp with time zone ,"
+                         " PRIMARY KEY (experiment, selection, source, model, request_id)"
+                         ");")
+        self.conn.commit()
+
+    def enqueue_normalized_requests(self, experiment_id: int, selection: str, request_ids: list[int],
+                                    source: str, model: str) -> int:
+        values = [(experiment_id, selection, request_id, source, model) for request_id in request_ids]
+        inserted = execute_values(self.cur,
+                                  SQL("INSERT INTO pluginadblock.request_llm_queue "
+                                      "(experiment, selection, request_id, source, model) "
+                                      "SELECT * FROM (VALUES %s) AS v (experiment, selection, rid, source, model) "
+                                      "WHERE NOT EXISTS "
+                                      "( SELECT request_id FROM pluginadblock.request_llm_analyzed "
+                                      "  WHERE request_id = v.rid AND source = v.source and model = v.model) "
+                                      "ON CONFLICT DO NOTHING "
+                                      "RETURNING request_id;"),
+                                  values, fetch=True)
+        self.conn.commit()
+        return len(inserted)
+
+    def claim_normalized_requests(self, worker: str, experiment_id: int, selection: str, source: str, model: str,
+                                  batch_size: int, lease_seconds: int) -> list[int]:
+        # unclaimed requests of the same analysis and those whose worker let the lease expire,
+        # e.g. because it crashed
+        self.cur.execute("UPDATE pluginadblock.request_llm_queue q "
+                         "SET claimed_by = %s, lease_until = now() + make_interval(secs => %s) "
+                         "FROM ( SELECT experiment, selection, source, model, request_id "
+                         "       FROM pluginadblock.request_llm_queue "
+                         "       WHERE experiment = %s AND selection = %s AND source = %s AND model = %s "
+                         "         AND (lease_until IS NULL OR lease_until < now()) "
+                         "       ORDER BY request_id "
+                         "       LIMIT %s "
+                         "       FOR UPDATE SKIP LOCKED ) AS c "
+                         "WHERE q.experiment = c.experiment AND q.selection = c.selection "
+                         "  AND q.source = c.source AND q.model = c.model AND q.request_id = c.request_id "
+                         "RETURNING q.request_id;",
+                         (worker, lease_seconds, experiment_id, selection, source, model, batch_size))
+        request_ids = [r[0] for r in self.cur.fetchall()]
+        self.conn.commit()
+        return request_ids
+
     def get_normalized_request_ids_analyzed(self, source: str, model: str) -> list[int]:
         self.cur.execute("SELECT request_id "
                          "FROM pluginadblock.request_llm_analyzed "
@@ -135,3 +314,150 @@ class Database:
                 private_data[request_id] = list()
             private_data[request_id].append(data)
         return private_data
+
+    def ensure_pipeline_checkpoints(self) -> None:
+        self.cur.execute("CREATE SCHEMA IF NOT EXISTS pluginadblock;")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS pluginadblock.pipeline_checkpoint ("
+                         " experiment integer NOT NULL ,"
+                         " stage varchar NOT NULL ,"
+                         " config varchar NOT NULL ,"
+                         " finished_at timestamp with time zone NOT NULL DEFAULT now() ,"
+                         " PRIMARY KEY (experiment, stage, config)"
+                         ");")
+        self.conn.commit()
+
+    def get_pipeline_checkpoints(self, experiment_id: int) -> set[tuple[str, str]]:
+        self.cur.execute("SELECT stage, config "
+                         "FROM pluginadblock.pipeline_checkpoint "
+                         "WHERE experiment = %s;", (experiment_id,))
+        self.conn.commit()
+        return {(r[0], r[1]) for r in self.cur.fetchall()}
+
+    def set_pipeline_checkpoint(self, experiment_id: int, stage: str, config: str) -> None:
+        self.cur.execute("INSERT INTO pluginadblock.pipeline_checkpoint (experiment, stage, config) "
+                         "VALUES (%s, %s, %s) "
+                         "ON CONFLICT (experiment, stage, config) DO UPDATE SET finished_at = now();",
+                         (experiment_id, stage, config))
+        self.conn.commit()
+
+    def delete_pipeline_checkpoints(self, experiment_id: int, stages: list[str]) -> int:
+        self.cur.execute("DELETE FROM pluginadblock.pipeline_checkpoint "
+                         "WHERE experiment = %s AND stage = ANY(%s);", (experiment_id, stages))
+        deleted = self.cur.rowcount
+        self.conn.commit()
+        return deleted
+
+    def buffered_writer(self, flush_requests: int = FLUSH_REQUESTS,
+                        flush_seconds: float = FLUSH_SECONDS) -> "BufferedWriter":
+        return BufferedWriter(self, flush_requests, flush_seconds)
+
+    def ensure_private_data_constraints(self) -> bool:
+        # keys and values are hashed as they may exceed the size of a btree entry
+        try:
+            self.cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS private_data_unique "
+                             "ON private_data (request_id, category, md5(key), md5(value), source, model);")
+            self.cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS request_llm_analyzed_unique "
+                             "ON pluginadblock.request_llm_analyzed (request_id, source, model);")
+            self.conn.commit()
+            return True
+        except psycopg2.Error as e:
+            self.conn.rollback()
+            print(f"unique constraints could not be created, checking for duplicates on insert instead: {e}",
+                  file=sys.stderr)
+            return False
+
+    def has_private_data_constraints(self) -> bool:
+        # the unique indexes are created by migrate.py, without them inserts check for duplicates
+        self.cur.execute("SELECT to_regclass('private_data_unique') IS NOT NULL "
+                         "AND to_regclass('pluginadblock.request_llm_analyzed_unique') IS NOT NULL;")
+        constrained = self.cur.fetchone()[0]
+        self.conn.commit()
+        if not constrained:
+            print("private_data has no unique constraints, checking for duplicates on insert instead, "
+                  "create them with migrate.py", file=sys.stderr)
+        return constrained
+
+
+def _pipeline_row(row: tuple) -> tuple[Request, str, bool]:
+    return Request(row[0], row[1], row[2], row[3], content_digest=row[4]), row[5], row[4] is not None
+
+
+class BufferedWriter:
+    # collects the private data and analyzed markers of analyzed requests and writes them in one
+    # transaction every flush_requests requests or flush_seconds seconds, on exit and on SIGTERM
+    def __init__(self, db: Database, flush_requests: int = FLUSH_REQUESTS, flush_seconds: float = FLUSH_SECONDS):
+        self.db = db
+        self.flush_requests = flush_requests
+        self.flush_seconds = flush_seconds
+        self.constrained = db.has_private_data_constraints()
+        self._private_data: list[tuple] = []
+        self._analyzed: list[tuple[int, str, str]] = []
+        self._dequeued: list[tuple[int, str, str]] = []
+        self._last_flush = time.monotonic()
+        atexit.register(self.flush)
+        if threading.current_thread() is threading.main_thread() \
+                and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            # exiting runs the atexit flush
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    def add(self, request: Request, private_data: list[PrivateData], source: str, model: str,
+            dequeue: bool = False) -> None:
+        self._private_data += [(request.req_id, pd.category, pd.key, pd.value, pd.source, pd.model, pd.count)
+                               for pd in private_data]
+        self._analyzed.append((request.req_id, source, model))
+        if dequeue:
+            self._dequeued.append((request.req_id, source, model))
+        if len(self._analyzed) >= self.flush_requests or time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if len(self._analyzed) == 0:
+            return
+        with metrics.stage("db_write"):
+            self._write()
+        print(f"flushed private data of {len(self._analyzed)} requests")
+        self._private_data = []
+        self._analyzed = []
+        self._dequeued = []
+
+    def _write(self) -> None:
+        cur = self.db.cur
+        guard = "" if self.constrained else (
+            "WHERE NOT EXISTS "
+            "( SELECT request_id FROM private_data "
+            "  WHERE request_id = v.rid AND category = v.category "
+            "    AND key = v.key AND value = v.value AND source = v.source"
+            "    AND model = v.model) ")
+        try:
+            if len(self._private_data) > 0:
+                execute_values(cur,
+                               SQL("INSERT INTO private_data (request_id, category, key, value, source, model, times) "
+                                   "SELECT * FROM (VALUES %s) AS v (rid, category, key, value, source, model, times) "
+                                   f"{guard}"
+                                   "ON CONFLICT DO NOTHING"),
+                               self._private_data)
+            guard = "" if self.constrained else (
+                "WHERE NOT EXISTS "
+                "( SELECT request_id FROM pluginadblock.request_llm_analyzed "
+                "  WHERE request_id = v.rid AND source = v.source and model = v.model) ")
+            execute_values(cur,
+                           SQL("INSERT INTO pluginadblock.request_llm_analyzed (request_id, source, model) "
+                               "SELECT * FROM (VALUES %s) AS v (rid, source, model) "
+                               f"{guard}"
+                               "ON CONFLICT DO NOTHING"),
+                           self._analyzed)
+            if len(self._dequeued) > 0:
+                execute_values(cur,
+                               SQL("DELETE FROM pluginadblock.request_llm_queue q "
+                                   "USING (VALUES %s) AS v (rid, source, model) "
+                                   "WHERE q.request_id = v.rid AND q.source = v.source AND q.model = v.model"),
+                               self._dequeued)
+            self.db.conn.commit()
+        except psycopg2.Error:
+            self.db.conn.rollback()
+            raise
+
+    def close(self) -> None:
+        self.flush()
+        atexit.unregister(self.flush)
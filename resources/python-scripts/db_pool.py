@@ -0,0 +1,130 @@
+import argparse
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+from psycopg2 import pool
+
+MAX_CONNECTIONS = 8
+STATEMENT_TIMEOUT = None
+WORK_MEM = None
+
+_settings = {"max_connections": MAX_CONNECTIONS, "statement_timeout": STATEMENT_TIMEOUT, "work_mem": WORK_MEM}
+_pool: pool.ThreadedConnectionPool | None = None
+_pool_pid: int | None = None
+_lock = threading.Lock()
+# The pools a forked child inherited, with the connections they hand out. They stay referenced, as closing
+# or garbage collecting them in the child would terminate the sessions of the parent over the shared sockets.
+_inherited: list[pool.ThreadedConnectionPool] = []
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--db-connections", type=int, default=MAX_CONNECTIONS,
+                        help="maximum number of pooled database connections")
+    parser.add_argument("--statement-timeout", default=os.environ.get("DB_STATEMENT_TIMEOUT") or STATEMENT_TIMEOUT,
+                        help="postgres statement_timeout of every session, e.g. 30min, 0 disables it, "
+                             "by default that of the server or role")
+    parser.add_argument("--work-mem", default=os.environ.get("DB_WORK_MEM") or WORK_MEM,
+                        help="postgres work_mem of every session, e.g. 256MB")
+
+
+def configure(max_connections: int = MAX_CONNECTIONS, statement_timeout: str | None = STATEMENT_TIMEOUT,
+              work_mem: str | None = WORK_MEM) -> None:
+    # only takes effect before the first connection is handed out
+    _settings.update(max_connections=max_connections, statement_timeout=statement_timeout, work_mem=work_mem)
+
+
+def configure_from_args(args: argparse.Namespace) -> None:
+    configure(args.db_connections, args.statement_timeout, args.work_mem)
+
+
+def _session_options() -> str:
+    # only the configured settings, the others keep the defaults of the server or role
+    options = []
+    if _settings["statement_timeout"] is not None:
+        options.append(f"-c statement_timeout={_settings['statement_timeout']}")
+    if _settings["work_mem"] is not None:
+        options.append(f"-c work_mem={_settings['work_mem']}")
+    return " ".join(options)
+
+
+def _after_fork_in_child() -> None:
+    # connections must not be shared with forked processes, which create their own pool
+    global _pool, _pool_pid, _lock
+    if _pool is not None:
+        _inherited.append(_pool)
+    _pool = None
+    _pool_pid = None
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def get_pool() -> pool.ThreadedConnectionPool:
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = pool.ThreadedConnectionPool(0, _settings["max_connections"],
+                                                host=os.environ.get('POSTGRES_HOST') or 'localhost',
+                                                port=os.environ['HOST_PORT'],
+                                                dbname=os.environ['POSTGRES_DB'],
+                                                user=os.environ['POSTGRES_USER'],
+                                                password=os.environ['POSTGRES_PASSWORD'],
+                                                options=_session_options())
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def acquire():
+    return get_pool().getconn()
+
+
+def release(conn) -> None:
+    if _pool is not None and _pool_pid == os.getpid() and not _pool.closed:
+        _pool.putconn(conn, close=conn.closed != 0)
+
+
+@contextmanager
+def connection() -> Iterator:
+    conn = acquire()
+    try:
+        yield conn
+    finally:
+        release(conn)
+
+
+class PooledSession:
+    # borrows a connection from the pool on first use and keeps it until close
+    def __init__(self):
+        self._conn = None
+        self._cur = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = acquire()
+        return self._conn
+
+    @property
+    def cur(self):
+        if self._cur is None:
+            self._cur = self.conn.cursor()
+        return self._cur
+
+    def close(self) -> None:
+        if self._cur is not None:
+            self._cur.close()
+        if self._conn is not None:
+            release(self._conn)
+        self._conn = None
+        self._cur = None
+
+
+def close() -> None:
+    global _pool
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
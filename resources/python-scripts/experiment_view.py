@@ -0,0 +1,40 @@
+SCHEMA = "pluginexperiment"
+# the requests of every materialized experiment with their analysis, app and content digest, see migrate.py
+REQUEST_TABLE = f"{SCHEMA}.experimentrequest"
+# per experiment the state of the analyses and requests it was materialized from
+REFRESH_TABLE = f"{SCHEMA}.experimentrefresh"
+
+ANALYSES_QUERY = ("SELECT count(*), count(*) FILTER (WHERE ia.success IS true) "
+                  "FROM interfaceanalysis ia "
+                  "WHERE ia.experiment = %s;")
+# the state a materialization is compared against, requests committed out of id order change the count
+REQUESTS_STATE_QUERY = ("SELECT coalesce(max(r.id), 0), count(*) "
+                        "FROM interfaceanalysis ia "
+                        "INNER JOIN trafficcollection tc on tc.analysis = ia.id "
+                        "INNER JOIN request r on r.run = tc.id "
+                        "WHERE ia.experiment = %s;")
+
+
+def is_current(cur, experiment_id: int) -> bool:
+    # Whether the queries of an experiment can read from the view. It is used if the experiment was
+    # materialized and neither its analyses nor the id range and count of its requests changed since,
+    # the same state migrate.py refreshes the experiment on.
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (REFRESH_TABLE,))
+    if not cur.fetchone()[0]:
+        return False
+    cur.execute(f"SELECT analyses, successful_analyses, max_request_id, requests "
+                f"FROM {REFRESH_TABLE} "
+                f"WHERE experiment = %s;", (experiment_id,))
+    refreshed = cur.fetchone()
+    if refreshed is None:
+        return False
+    cur.execute(ANALYSES_QUERY, (experiment_id,))
+    if cur.fetchone() != refreshed[:2]:
+        print(f"experiment {experiment_id} changed since it was materialized, refresh it with migrate.py")
+        return False
+    cur.execute(REQUESTS_STATE_QUERY, (experiment_id,))
+    if cur.fetchone() != refreshed[2:]:
+        print(f"the requests of experiment {experiment_id} changed since it was materialized, "
+              f"refresh it with migrate.py")
+        return False
+    return True
@@ -0,0 +1,288 @@
+import argparse
+import io
+import json
+import re
+import sys
+import types
+from collections import Counter
+from pathlib import Path
+
+from psycopg2.sql import SQL
+
+import db_pool
+import experiment_view
+import metrics
+from db_pool import PooledSession
+from experiment_view import REQUEST_TABLE
+
+TRAFFIC_COLLECTION_DIR = Path(__file__).parent.parent / "trafficCollection"
+ENDPOINT_SOURCE = "relevantEndpointHosts"
+EXODUS_SOURCE = "exodus"
+# the sources of earlier runs, which were named after the exodus export
+LEGACY_EXODUS_SOURCES = "exodus\\_tracker\\_%%"
+EXPERIMENT_HOSTS_QUERY = ("SELECT DISTINCT r.host "
+                          "FROM interfaceanalysis ia "
+                          "INNER JOIN trafficcollection tc on tc.analysis = ia.id "
+                          "INNER JOIN request r on r.run = tc.id "
+                          "WHERE ia.experiment = %s AND r.host IS NOT NULL")
+VIEW_HOSTS_QUERY = ("SELECT DISTINCT er.host "
+                    f"FROM {REQUEST_TABLE} er "
+                    "WHERE er.experiment = %s AND er.host IS NOT NULL")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="classify the request hosts of an experiment "
+                                                 "by exodus network signatures and relevant endpoint hosts")
+    parser.add_argument("experiment_id", type=int)
+    parser.add_argument("--exodus", type=Path, default=latest_exodus_file(),
+                        help="exodus tracker json, by default the latest one in trafficCollection")
+    parser.add_argument("--config", type=Path, default=TRAFFIC_COLLECTION_DIR / "config.json",
+                        help="traffic collection config with the relevantEndpointHosts")
+    db_pool.add_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    db_pool.configure_from_args(args)
+    metrics.configure_from_args(f"host_classifier:{args.experiment_id}", args)
+
+    signatures = load_exodus_signatures(args.exodus) + load_endpoint_signatures(args.config)
+    classifier = HostClassifier(signatures)
+    try:
+        classifier.classify_experiment(args.experiment_id)
+    finally:
+        classifier.close()
+        db_pool.close()
+        metrics.finish()
+
+
+def latest_exodus_file() -> Path | None:
+    files = sorted(TRAFFIC_COLLECTION_DIR.glob("exodus_tracker_*.json"))
+    return files[-1] if len(files) > 0 else None
+
+
+class Signature:
+    def __init__(self, source: str, tracker_id: str, name: str, pattern: str, version: str | None = None):
+        self.source = source
+        self.tracker_id = tracker_id
+        self.name = name
+        self.pattern = pattern
+        # the export the signature was taken from
+        self.version = version
+
+    def __repr__(self):
+        return f"Signature({self.source} {self.version}: {self.tracker_id} {self.name} - {self.pattern})"
+
+
+def load_exodus_signatures(path: Path) -> list[Signature]:
+    # older exports map the ids to the trackers, newer ones list the trackers with their id
+    with open(path) as f:
+        trackers = json.load(f)["trackers"]
+    if isinstance(trackers, dict):
+        trackers = [{"id": tracker_id, **tracker} for tracker_id, tracker in trackers.items()]
+    return [Signature(EXODUS_SOURCE, str(t["id"]), t["name"], t["network_signature"], path.stem)
+            for t in trackers if t.get("network_signature")]
+
+
+def load_endpoint_signatures(path: Path) -> list[Signature]:
+    with open(path) as f:
+        hosts = json.load(f)["relevantEndpointHosts"]
+    return [Signature(ENDPOINT_SOURCE, host, host, host) for host in hosts]
+
+
+GRAM_SIZE = 3
+REGEX_META = set(".^$*+?{}()[]|\\")
+OPTIONAL_QUANTIFIERS = set("*?{")
+
+
+def split_alternatives(pattern: str) -> list[str]:
+    # the top level alternatives, i.e. those not within a group or character class
+    alternatives = [""]
+    depth = 0
+    in_class = False
+    escaped = False
+    for c in pattern:
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif in_class:
+            in_class = c != "]"
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            alternatives.append("")
+            continue
+        alternatives[-1] += c
+    return alternatives
+
+
+def required_literal(alternative: str) -> str:
+    # the longest run of characters every match of the alternative contains
+    runs = [""]
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(alternative):
+        c = alternative[i]
+        literal = None
+        if in_class:
+            in_class = c != "]" or (c == "]" and alternative[i - 1] == "\\")
+        elif c == "\\":
+            i += 1
+            escaped = alternative[i] if i < len(alternative) else ""
+            literal = escaped if escaped != "" and not escaped.isalnum() else None
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c not in REGEX_META and depth == 0:
+            literal = c
+        if literal is not None and depth == 0:
+            runs[-1] += literal
+        elif c in OPTIONAL_QUANTIFIERS and not in_class:
+            # the quantified character or group may be missing
+            runs[-1] = runs[-1][:-1]
+            runs.append("")
+            if c == "{":
+                i = alternative.find("}", i) if "}" in alternative[i:] else len(alternative)
+        else:
+            runs.append("")
+        i += 1
+    return max(runs, key=len)
+
+
+class CompiledSignatures:
+    # Signatures are searched unanchored within the host, as by the traffic analysis. Each signature is
+    # indexed by a character trigram that every host it matches contains, so a host only has to be checked
+    # against the few signatures sharing one of its trigrams instead of against all of them.
+    def __init__(self, signatures: list[Signature]):
+        self.signatures: list[Signature] = []
+        self.patterns: list[re.Pattern] = []
+        for signature in signatures:
+            try:
+                self.patterns.append(re.compile(signature.pattern))
+                self.signatures.append(signature)
+            except re.error as e:
+                print(f"ignoring invalid network signature {signature}: {e}", file=sys.stderr)
+        literals = [[required_literal(a) for a in split_alternatives(p.pattern)] for p in self.patterns]
+        frequency = Counter(gram for alternatives in literals for literal in alternatives
+                            for gram in _grams(literal))
+        self.index: dict[str, list[int]] = dict()
+        self.unindexed: list[int] = []
+        for i, alternatives in enumerate(literals):
+            if self.patterns[i].flags & re.IGNORECASE or any(len(literal) < GRAM_SIZE for literal in alternatives):
+                self.unindexed.append(i)
+                continue
+            for gram in {min(_grams(literal), key=lambda g: frequency[g]) for literal in alternatives}:
+                self.index.setdefault(gram, []).append(i)
+
+    def classify(self, host: str) -> list[Signature]:
+        candidates = set(self.unindexed)
+        for gram in _grams(host):
+            candidates.update(self.index.get(gram, ()))
+        return [self.signatures[i] for i in sorted(candidates) if self.patterns[i].search(host) is not None]
+
+
+def _grams(text: str) -> list[str]:
+    return [text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)]
+
+
+class HostClassifier(PooledSession):
+
+    def __init__(self, signatures: list[Signature]):
+        super().__init__()
+        self.sql = types.SimpleNamespace()
+        self.sql.plugin_schema = "pluginhostclassifier"
+        self.sql.request_tracker_table = "requesttracker"
+        self.sql.host_tracker_load_table = "hosttracker_load"
+        self.signatures = CompiledSignatures(signatures)
+        self.sources = sorted({s.source for s in self.signatures.signatures})
+
+    def classify_hosts(self, hosts: list[str]) -> dict[str, list[Signature]]:
+        classified = {host: self.signatures.classify(host) for host in hosts}
+        return {host: signatures for host, signatures in classified.items() if len(signatures) > 0}
+
+    def classify_experiment(self, experiment_id: int) -> None:
+        # every distinct host is classified once, the database expands the results to the requests
+        self._ensure_schema()
+        with metrics.stage("fetch"):
+            hosts = self._get_experiment_hosts(experiment_id)
+        with metrics.stage("match"):
+            classified = self.classify_hosts(hosts)
+        print(f"{len(classified)} of {len(hosts)} distinct hosts match one of {len(self.signatures.signatures)} "
+              f"signatures")
+        with metrics.stage("db_write"):
+            self._save_results(experiment_id, classified)
+
+    def _get_experiment_hosts(self, experiment_id: int) -> list[str]:
+        query = VIEW_HOSTS_QUERY if experiment_view.is_current(self.cur, experiment_id) else EXPERIMENT_HOSTS_QUERY
+        self.cur.execute(query, (experiment_id,))
+        self.conn.commit()
+        return [r[0] for r in self.cur.fetchall()]
+
+    def _save_results(self, experiment_id: int, classified: dict[str, list[Signature]]) -> None:
+        # the results of the experiment are replaced for the sources used, so changed signatures take effect
+        tracker_table = f"{self.sql.plugin_schema}.{self.sql.request_tracker_table}"
+        self.cur.execute(SQL(f"CREATE TEMPORARY TABLE IF NOT EXISTS {self.sql.host_tracker_load_table} ("
+                             f" host varchar NOT NULL ,"
+                             f" source varchar NOT NULL ,"
+                             f" tracker_id varchar NOT NULL ,"
+                             f" tracker_name varchar NOT NULL ,"
+                             f" signature_version varchar"
+                             f") ON COMMIT DELETE ROWS;"))
+        rows = io.StringIO("".join(f"{_copy_text(host)}\t{_copy_text(s.source)}\t{_copy_text(s.tracker_id)}\t"
+                                   f"{_copy_text(s.name)}\t{_copy_text(s.version)}\n"
+                                   for host, signatures in classified.items() for s in signatures))
+        self.cur.copy_expert(SQL(f"COPY {self.sql.host_tracker_load_table} "
+                                 f"(host, source, tracker_id, tracker_name, signature_version) "
+                                 f"FROM STDIN"), rows)
+        self.cur.execute(SQL(f"DELETE FROM {tracker_table} rt "
+                             f"USING request r, trafficcollection tc, interfaceanalysis ia "
+                             f"WHERE rt.request_id = r.id AND r.run = tc.id AND tc.analysis = ia.id "
+                             f"AND ia.experiment = %s "
+                             f"AND (rt.source = ANY(%s) OR (%s AND rt.source LIKE '{LEGACY_EXODUS_SOURCES}'))"),
+                         (experiment_id, self.sources, EXODUS_SOURCE in self.sources))
+        deleted = self.cur.rowcount
+        self.cur.execute(SQL(f"INSERT INTO {tracker_table} "
+                             f"(request_id, source, tracker_id, tracker_name, signature_version) "
+                             f"SELECT r.id, l.source, l.tracker_id, l.tracker_name, l.signature_version "
+                             f"FROM interfaceanalysis ia "
+                             f"INNER JOIN trafficcollection tc on tc.analysis = ia.id "
+                             f"INNER JOIN request r on r.run = tc.id "
+                             f"INNER JOIN {self.sql.host_tracker_load_table} l on l.host = r.host "
+                             f"WHERE ia.experiment = %s "
+                             f"ON CONFLICT DO NOTHING"), (experiment_id,))
+        inserted = self.cur.rowcount
+        self.conn.commit()
+        print(f"{deleted} previous rows replaced by {inserted} rows")
+
+    def _ensure_schema(self):
+        self.cur.execute(SQL(f"CREATE SCHEMA IF NOT EXISTS {self.sql.plugin_schema}"))
+        self.cur.execute(SQL(f"CREATE TABLE IF NOT EXISTS "
+                             f"{self.sql.plugin_schema}.{self.sql.request_tracker_table} ("
+                             f" request_id integer NOT NULL REFERENCES public.request(id) "
+                             f"  ON UPDATE CASCADE ON DELETE CASCADE ,"
+                             f" source varchar NOT NULL ,"
+                             f" tracker_id varchar NOT NULL ,"
+                             f" tracker_name varchar NOT NULL ,"
+                             f" signature_version varchar ,"
+                             f" PRIMARY KEY (request_id, source, tracker_id)"
+                             f");"))
+        self.cur.execute(SQL(f"ALTER TABLE {self.sql.plugin_schema}.{self.sql.request_tracker_table} "
+                             f"ADD COLUMN IF NOT EXISTS signature_version varchar;"))
+        self.conn.commit()
+
+
+def _copy_text(value: str | None) -> str:
+    if value is None:
+        return "\\N"
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,23 @@
+import asyncio
+import re
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import backoff
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+import metrics
+from local_extractor import LocalExtractor
 from private_data import PrivateData
+from prompt_cache import PromptCache
 from datetime import datetime
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 instructions = """
 You are an assistant in evaluating the private data contained in network requests from apps on an android phone.
 You consider the following categories of data private data:
@@ -64,69 +77,439 @@ You only provide output if you can identify the data categories and the correspo
 Otherwise your only output is: no-data
 """
 
+packed_instructions = instructions + """
+You receive several inputs at once. Each input starts with a line <<<payload ID>>> and ends with a line <<<end ID>>>.
+You evaluate every input on its own.
+For each input you first output the line <<<payload ID>>> with the ID of the input,
+followed by the comma separated values for that input or no-data.
+"""
+
 gpt4 = "gpt-4-1106-preview"
 gpt3 = "gpt-3.5-turbo"
 gpt3_16k = "gpt-3.5-turbo-16k"
 
+DEFAULT_CONCURRENCY = 16
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 300_000
+MAX_TOKENS = 403
+
+# payloads up to this size are packed together, up to the context and answer size of the model
+PACK_ITEM_TOKENS = 256
+PACKED_ANSWER_TOKENS = 150
+MODEL_CONTEXT_TOKENS = {gpt4: 128_000, gpt3: 4_096, gpt3_16k: 16_385}
+MODEL_OUTPUT_TOKENS = {gpt4: 4_096, gpt3: 4_096, gpt3_16k: 4_096}
+# models a prompt may be routed to if it does not fit the requested one, smallest first
+MODEL_FALLBACKS = {gpt4: [gpt4], gpt3: [gpt3, gpt3_16k], gpt3_16k: [gpt3_16k]}
+MESSAGE_OVERHEAD_TOKENS = 16
+CHARS_PER_TOKEN = 4
+CHUNK_OVERLAP_TOKENS = 200
+CHUNK_WORKERS = 8
+PACKED_HEADER = re.compile(r"^<<<payload (\d+)>>>$")
+# the end of an input, which models tend to echo after the answer of the input
+PACKED_END = re.compile(r"^<<<end (\d+)>>>$")
+
+
+def completion_arguments(model: str, prompt: str) -> dict:
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.68,
+        max_tokens=MAX_TOKENS,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0,
+        stop=["no-data"]
+    )
+
+
+def packed_completion_arguments(model: str, pack: list[str]) -> dict:
+    payloads = "\n".join(f"<<<payload {i}>>>\n{prompt}\n<<<end {i}>>>" for i, prompt in enumerate(pack, 1))
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": packed_instructions},
+            {"role": "user", "content": payloads}
+        ],
+        temperature=0.68,
+        max_tokens=min(MODEL_OUTPUT_TOKENS[model], PACKED_ANSWER_TOKENS * len(pack)),
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0,
+    )
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    # all supported models share the cl100k_base encoding
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"{datetime.now()}: tokenizer unavailable, estimating token counts: {e}", file=sys.stderr)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        # rough estimate of ~4 characters per token
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def prompt_budget(model: str) -> int:
+    # tokens left for the user prompt next to the instructions and the answer
+    return MODEL_CONTEXT_TOKENS[model] - MAX_TOKENS - count_tokens(instructions) - MESSAGE_OVERHEAD_TOKENS
+
+
+def route_model(model: str, prompt: str) -> str | None:
+    # the first model able to fit the prompt, None if it has to be split
+    tokens = count_tokens(prompt)
+    for candidate in MODEL_FALLBACKS[model]:
+        if tokens <= prompt_budget(candidate):
+            return candidate
+    return None
+
+
+def chunk_prompt(model: str, prompt: str) -> list[str]:
+    # overlapping chunks fitting the largest model available for model
+    size = prompt_budget(MODEL_FALLBACKS[model][-1])
+    step = size - CHUNK_OVERLAP_TOKENS
+    encoding = _encoding()
+    if encoding is None:
+        size, step = size * CHARS_PER_TOKEN // 2, step * CHARS_PER_TOKEN // 2
+        return [prompt[i:i + size] for i in range(0, max(len(prompt) - size + step, 1), step)]
+    tokens = encoding.encode(prompt, disallowed_special=())
+    return [encoding.decode(tokens[i:i + size]) for i in range(0, max(len(tokens) - size + step, 1), step)]
+
+
+def merge_private_data(chunk_results: list[list[PrivateData]]) -> list[PrivateData]:
+    # pairs found in the overlap of two chunks are only kept once
+    merged: dict[tuple[str, str, str], PrivateData] = dict()
+    for private_data in chunk_results:
+        for data in private_data:
+            merged.setdefault((data.category, data.key, data.value), data)
+    return list(merged.values())
+
+
+def estimate_tokens(arguments: dict) -> int:
+    # tokens a completion counts against the rate limit, including the answer
+    return sum(count_tokens(message["content"]) for message in arguments["messages"]) + arguments["max_tokens"]
+
+
+def pack_prompts(model: str, prompts: list[tuple[int, str]]) -> list[list[tuple[int, str]]]:
+    # the payloads and their answers share the context, every answer takes PACKED_ANSWER_TOKENS
+    budget = MODEL_CONTEXT_TOKENS[model] - count_tokens(packed_instructions)
+    max_items = MODEL_OUTPUT_TOKENS[model] // PACKED_ANSWER_TOKENS
+    packs: list[list[tuple[int, str]]] = []
+    pack_tokens = 0
+    for item in prompts:
+        # delimiter lines included
+        tokens = count_tokens(item[1]) + 16 + PACKED_ANSWER_TOKENS
+        if len(packs) == 0 or len(packs[-1]) >= max_items or pack_tokens + tokens > budget:
+            packs.append([])
+            pack_tokens = 0
+        packs[-1].append(item)
+        pack_tokens += tokens
+    return packs
+
+
+def parse_private_data_line(line: str, source: str, model: str) -> PrivateData | None:
+    category, key, value = line.split(",")
+    data = PrivateData(category.strip().replace(' ', ''), key.strip(), value.strip(), source, model)
+    header = PrivateData("Data Category", "Key", "Value", source, model)
+    return None if data.same_value(header) else data
+
+
+def parse_private_data(answer: str | None, source: str, model: str) -> list[PrivateData]:
+    private_data: list[PrivateData] = []
+    if answer is not None and answer != "":
+        for line in answer.split("\n"):
+            try:
+                data = parse_private_data_line(line, source, model)
+                if data is not None:
+                    private_data.append(data)
+            except ValueError as e:
+                print(f"{datetime.now()}: llm answer could not be parsed: {line}", file=sys.stderr)
+    return private_data
+
+
+def parse_packed_answer(answer: str | None, size: int, truncated: bool,
+                        source: str, model: str) -> dict[int, list[PrivateData]]:
+    # answers of payloads that are missing, truncated or contain unparsable lines are left out
+    sections: dict[int, list[PrivateData]] = dict()
+    failed: set[int] = set()
+    current = None
+    for line in ("" if answer is None else answer).split("\n"):
+        line = line.strip()
+        header = PACKED_HEADER.match(line)
+        if header is not None:
+            current = int(header.group(1))
+            sections.setdefault(current, [])
+        elif PACKED_END.match(line) is not None:
+            current = None
+        elif line == "" or line == "no-data":
+            continue
+        elif current is None:
+            print(f"{datetime.now()}: packed llm answer could not be attributed: {line}", file=sys.stderr)
+        else:
+            try:
+                data = parse_private_data_line(line, source, model)
+                if data is not None:
+                    sections[current].append(data)
+            except ValueError:
+                failed.add(current)
+    if truncated and current is not None:
+        failed.add(current)
+    return {i: data for i, data in sections.items() if 1 <= i <= size and i not in failed}
+
+
+def _count_retry(details) -> None:
+    metrics.count("llm_retries", model=details["kwargs"].get("model"))
+
+
+def _count_routing(model: str, routed: str | None) -> None:
+    if routed != model:
+        metrics.count("llm_fallbacks", model=model, to="chunks" if routed is None else routed)
+
+
+def _split_batch(prompts: list[str], extractor: LocalExtractor | None, cache: PromptCache | None,
+                 model: str, source: str) -> tuple[list[list[PrivateData] | None], list[int], list[int]]:
+    # local and cached answers, indices of prompts to pack and of prompts too large for packing
+    results: list[list[PrivateData] | None] = [None] * len(prompts)
+    small: list[int] = []
+    large: list[int] = []
+    for i, prompt in enumerate(prompts):
+        if extractor is not None:
+            results[i] = extractor.extract(prompt, source)
+        if results[i] is None and cache is not None:
+            results[i] = cache.get(completion_arguments(model, prompt), source, model)
+        if results[i] is None:
+            (small if count_tokens(prompt) <= PACK_ITEM_TOKENS else large).append(i)
+    return results, small, large
+
+
+def _cache_packed_answers(cache: PromptCache | None, model: str, pack: list[str],
+                          answers: dict[int, list[PrivateData]]) -> None:
+    # every answer is cached as the answer of its single prompt, which is what _split_batch looks up
+    if cache is not None:
+        for position, private_data in answers.items():
+            cache.put(completion_arguments(model, pack[position - 1]), private_data)
+
 
 class LLM:
-    def __init__(self,  model: str, source: str):
+    def __init__(self,  model: str, source: str, cache: PromptCache | None = None,
+                 extractor: LocalExtractor | None = None):
         self._client = OpenAI(
             timeout=10.0
         )
         self.model = model
         self.source = source
-        self.header = PrivateData("Data Category", "Key", "Value", self.source, self.model)
+        self.cache = cache
+        self.extractor = extractor
 
     def __del__(self):
         self._client.close()
 
-    @backoff.on_exception(backoff.expo, openai.RateLimitError, max_tries=3, max_time=30.0)
+    @backoff.on_exception(backoff.expo, openai.RateLimitError, max_tries=3, max_time=30.0, on_backoff=_count_retry)
     def _completion_with_backoff(self, **kwargs):
+        start = time.perf_counter()
         try:
-            return self._client.with_options(timeout=10.0).chat.completions.create(**kwargs)
+            response = self._client.with_options(timeout=10.0).chat.completions.create(**kwargs)
+            metrics.record_llm_call(kwargs["model"], time.perf_counter() - start, response.usage)
+            return response
         except openai.BadRequestError as e:
             if e.code == 'context_length_exceeded' and self.model == gpt3:
+                metrics.count("llm_fallbacks", model=gpt3, to=gpt3_16k)
                 nargs = kwargs
                 nargs["model"] = gpt3_16k
                 return self._completion_with_backoff(**nargs)
                 # print(e)
                 # return None
             else:
+                metrics.count("llm_errors", model=kwargs["model"], kind=type(e).__name__)
                 print(e)
                 return None
         except openai.APITimeoutError as e:
+            metrics.count("llm_errors", model=kwargs["model"], kind=type(e).__name__)
             print(e)
             return None
 
     def get_private_data(self, prompt: str) -> list[PrivateData]:
-        print(f"prompting with size: {len(prompt)} - {prompt[:50]}")
-        response = self._completion_with_backoff(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": instructions},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.68,
-            max_tokens=403,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=["no-data"]
-        )
+        if self.extractor is not None:
+            local = self.extractor.extract(prompt, self.source)
+            if local is not None:
+                return local
+        model = route_model(self.model, prompt)
+        _count_routing(self.model, model)
+        if model is None:
+            chunks = chunk_prompt(self.model, prompt)
+            print(f"splitting prompt with size: {len(prompt)} into {len(chunks)} chunks")
+            with ThreadPoolExecutor(min(len(chunks), CHUNK_WORKERS)) as executor:
+                return merge_private_data(list(executor.map(self.get_private_data, chunks)))
+        arguments = completion_arguments(model, prompt)
+        if self.cache is not None:
+            cached = self.cache.get(arguments, self.source, self.model)
+            if cached is not None:
+                return cached
+        print(f"prompting {model} with size: {len(prompt)} - {prompt[:50]}")
+        response = self._completion_with_backoff(**arguments)
         if response is None:
             return []
         answer = response.choices[0].message.content
         print(answer)
-        private_data: list[PrivateData] = []
-        if answer is not None and answer != "":
-            for line in answer.split("\n"):
-                try:
-                    category, key, value = line.split(",")
-                    data = PrivateData(category.strip().replace(' ', ''), key.strip(), value.strip(), self.source, self.model)
-                    if not data.same_value(self.header):
-                        private_data.append(data)
-                except ValueError as e:
-                    print(f"{datetime.now()}: llm answer could not be parsed: {line}", file=sys.stderr)
+        private_data = parse_private_data(answer, self.source, self.model)
+        if self.cache is not None:
+            self.cache.put(arguments, private_data)
+        return private_data
+
+    def get_private_data_batch(self, prompts: list[str]) -> list[list[PrivateData]]:
+        results, small, large = _split_batch(prompts, self.extractor, self.cache, self.model, self.source)
+        for i in large:
+            results[i] = self.get_private_data(prompts[i])
+        for pack in pack_prompts(self.model, [(i, prompts[i]) for i in small]):
+            answers = self._get_packed_private_data([prompt for _, prompt in pack])
+            for position, (i, prompt) in enumerate(pack, 1):
+                results[i] = answers[position] if position in answers else self.get_private_data(prompt)
+        return results
+
+    def _get_packed_private_data(self, pack: list[str]) -> dict[int, list[PrivateData]]:
+        print(f"prompting {len(pack)} packed payloads with size: {sum(len(prompt) for prompt in pack)}")
+        response = self._completion_with_backoff(**packed_completion_arguments(self.model, pack))
+        if response is None:
+            return {}
+        choice = response.choices[0]
+        print(choice.message.content)
+        answers = parse_packed_answer(choice.message.content, len(pack), choice.finish_reason == "length",
+                                      self.source, self.model)
+        _cache_packed_answers(self.cache, self.model, pack, answers)
+        return answers
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.available = per_minute
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1) -> None:
+        amount = min(amount, self.capacity)
+        # waiters queue on the lock, so they are served in order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                await asyncio.sleep((amount - self.available) / self.rate)
+
 
+class AsyncLLM:
+    def __init__(self, model: str, source: str, concurrency: int = DEFAULT_CONCURRENCY,
+                 requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE, cache: PromptCache | None = None,
+                 extractor: LocalExtractor | None = None):
+        self._client = AsyncOpenAI(
+            timeout=10.0
+        )
+        self.model = model
+        self.source = source
+        self.cache = cache
+        self.extractor = extractor
+        self._concurrency = asyncio.Semaphore(concurrency)
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+
+    async def close(self):
+        await self._client.close()
+
+    @backoff.on_exception(backoff.expo, openai.RateLimitError, max_tries=3, max_time=30.0, on_backoff=_count_retry)
+    async def _completion_with_backoff(self, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self._client.with_options(timeout=10.0).chat.completions.create(**kwargs)
+            metrics.record_llm_call(kwargs["model"], time.perf_counter() - start, response.usage)
+            return response
+        except openai.BadRequestError as e:
+            if e.code == 'context_length_exceeded' and kwargs["model"] == gpt3:
+                metrics.count("llm_fallbacks", model=gpt3, to=gpt3_16k)
+                nargs = kwargs
+                nargs["model"] = gpt3_16k
+                return await self._completion_with_backoff(**nargs)
+            else:
+                metrics.count("llm_errors", model=kwargs["model"], kind=type(e).__name__)
+                print(e)
+                return None
+        except openai.APITimeoutError as e:
+            metrics.count("llm_errors", model=kwargs["model"], kind=type(e).__name__)
+            print(e)
+            return None
+
+    async def get_private_data(self, prompt: str) -> list[PrivateData]:
+        if self.extractor is not None:
+            local = self.extractor.extract(prompt, self.source)
+            if local is not None:
+                return local
+        model = route_model(self.model, prompt)
+        _count_routing(self.model, model)
+        if model is None:
+            chunks = chunk_prompt(self.model, prompt)
+            print(f"splitting prompt with size: {len(prompt)} into {len(chunks)} chunks")
+            return merge_private_data(await asyncio.gather(*[self.get_private_data(chunk) for chunk in chunks]))
+        arguments = completion_arguments(model, prompt)
+        if self.cache is not None:
+            cached = self.cache.get(arguments, self.source, self.model)
+            if cached is not None:
+                return cached
+        async with self._concurrency:
+            await self._requests.acquire()
+            await self._tokens.acquire(estimate_tokens(arguments))
+            print(f"prompting {model} with size: {len(prompt)} - {prompt[:50]}")
+            response = await self._completion_with_backoff(**arguments)
+        if response is None:
+            return []
+        answer = response.choices[0].message.content
+        print(answer)
+        private_data = parse_private_data(answer, self.source, self.model)
+        if self.cache is not None:
+            self.cache.put(arguments, private_data)
         return private_data
+
+    async def get_private_data_batch(self, prompts: list[str]) -> list[list[PrivateData]]:
+        results, small, large = _split_batch(prompts, self.extractor, self.cache, self.model, self.source)
+
+        async def single(i: int):
+            results[i] = await self.get_private_data(prompts[i])
+
+        async def packed(pack: list[tuple[int, str]]):
+            answers = await self._get_packed_private_data([prompt for _, prompt in pack])
+            for position, (i, prompt) in enumerate(pack, 1):
+                results[i] = answers[position] if position in answers else await self.get_private_data(prompt)
+
+        await asyncio.gather(*[single(i) for i in large],
+                             *[packed(pack) for pack in pack_prompts(self.model, [(i, prompts[i]) for i in small])])
+        return results
+
+    async def _get_packed_private_data(self, pack: list[str]) -> dict[int, list[PrivateData]]:
+        arguments = packed_completion_arguments(self.model, pack)
+        async with self._concurrency:
+            await self._requests.acquire()
+            await self._tokens.acquire(estimate_tokens(arguments))
+            print(f"prompting {len(pack)} packed payloads with size: {sum(len(prompt) for prompt in pack)}")
+            response = await self._completion_with_backoff(**arguments)
+        if response is None:
+            return {}
+        choice = response.choices[0]
+        print(choice.message.content)
+        answers = parse_packed_answer(choice.message.content, len(pack), choice.finish_reason == "length",
+                                      self.source, self.model)
+        _cache_packed_answers(self.cache, self.model, pack, answers)
+        return answers
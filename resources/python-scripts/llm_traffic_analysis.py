@@ -1,33 +1,108 @@
+import argparse
+import asyncio
+import hashlib
+import os
+import socket
 import sys
+import time
+from pathlib import Path
+from typing import Iterable
 
 from tqdm import tqdm
 
-from database import Database
-from llm import LLM
+import db_pool
+import metrics
+from database import BufferedWriter, Database, FLUSH_REQUESTS, FLUSH_SECONDS
+from llm import LLM, AsyncLLM, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE
+from local_extractor import DEFAULT_CONFIG as DEFAULT_EXTRACTOR_CONFIG, LocalExtractor
 from private_data import PrivateData, deduplicate_private_data
+from prompt_cache import PromptCache
 from request import NormalizedRequest
 from request import Request
 from llm import (gpt3, gpt4)
 
+# borrows its connection from the pool on first use, not on import
 db = Database()
 match_modes = ("tracking", "all")
+LEASE_SECONDS = 30 * 60
 
 
 def main():
-    experiment_id = int(sys.argv[1])
-    batch_size = int(sys.argv[2])
-    match_mode = sys.argv[3]
-    source = sys.argv[4]
+    parser = argparse.ArgumentParser(description="find private data in the requests of an experiment using an llm")
+    parser.add_argument("experiment_id", type=int)
+    parser.add_argument("batch_size", type=int,
+                        help="number of normalized requests to analyze, or to claim at once in queue mode")
+    parser.add_argument("match_mode", choices=match_modes)
+    parser.add_argument("source")
+    parser.add_argument("only_file", help="file with the app ids to analyze or 'none', "
+                                          "the tracking mode analyzes all apps")
+    add_analysis_arguments(parser)
+    db_pool.add_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    db_pool.configure_from_args(args)
+    metrics.configure_from_args(f"llm_traffic_analysis:{args.experiment_id}", args)
     model = gpt4
-    only_file = sys.argv[5]
-    if match_mode not in match_modes:
-        print(f"third argument must match one of these options: {match_modes}", file=sys.stderr)
-        return
-    if only_file != "none":
-        only_apps = read_only_file(only_file)
+    if args.only_file != "none":
+        only_apps = read_only_file(args.only_file)
     else:
         only_apps = list()
-    analyze_experiment(experiment_id, batch_size, match_mode, source, model, only_apps)
+    llm_config = llm_config_from_args(model, args.source, args)
+    writer = db.buffered_writer(args.flush_requests, args.flush_seconds)
+    try:
+        analyze_experiment(args.experiment_id, args.batch_size, args.match_mode, args.source, model, only_apps,
+                           args.queue, args.lease, llm_config, writer)
+    finally:
+        writer.close()
+        db.close()
+        db_pool.close()
+        metrics.finish()
+
+
+class LLMConfig:
+    def __init__(self, model: str, source: str, concurrency: int = 1,
+                 requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE, cache: PromptCache | None = None,
+                 pack: bool = False, extractor: LocalExtractor | None = None):
+        self.model = model
+        self.source = source
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.cache = cache
+        self.pack = pack
+        self.extractor = extractor
+
+
+def add_analysis_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--queue", action="store_true",
+                        help="claim batches from the shared work queue until it is empty, "
+                             "so several workers can analyze the same experiment")
+    parser.add_argument("--lease", type=int, default=LEASE_SECONDS,
+                        help="seconds after which a claimed batch of a crashed worker is handed out again")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="number of concurrent llm requests, more than one uses the asyncio client")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_REQUESTS_PER_MINUTE, help="llm requests per minute")
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TOKENS_PER_MINUTE, help="llm tokens per minute")
+    parser.add_argument("--prompt-cache", type=Path, default=None,
+                        help="sqlite file caching llm answers per prompt, defaults to $LLM_CACHE_PATH "
+                             "or .llm_cache.sqlite next to this script")
+    parser.add_argument("--no-prompt-cache", action="store_true", help="always ask the llm")
+    parser.add_argument("--pack", action="store_true",
+                        help="send small payloads of a batch together in as few completions as fit the model")
+    parser.add_argument("--flush-requests", type=int, default=FLUSH_REQUESTS,
+                        help="number of analyzed requests after which results are written to the database")
+    parser.add_argument("--flush-seconds", type=float, default=FLUSH_SECONDS,
+                        help="seconds after which buffered results are written to the database")
+    parser.add_argument("--local-extractor", type=Path, nargs="?", const=DEFAULT_EXTRACTOR_CONFIG, default=None,
+                        help="extract private data from json, form encoded and xml payloads with known keys "
+                             "locally and only ask the llm for the rest, optionally with a custom key config")
+
+
+def llm_config_from_args(model: str, source: str, args: argparse.Namespace) -> LLMConfig:
+    cache = None if args.no_prompt_cache else PromptCache(args.prompt_cache)
+    extractor = None if args.local_extractor is None else LocalExtractor(args.local_extractor)
+    return LLMConfig(model, source, args.concurrency, args.rpm, args.tpm, cache, args.pack, extractor)
 
 
 def read_only_file(only_file_path: str) -> list[str]:
@@ -37,16 +112,16 @@ def read_only_file(only_file_path: str) -> list[str]:
     return apps
 
 
-def normalize_requests(requests: list[Request]) -> dict[Request, list[Request]]:
+def normalize_requests(requests: Iterable[Request]) -> dict[Request, list[Request]]:
     normals: dict[Request, list[Request]] = dict()
+    normal_by_digest: dict[bytes, Request] = dict()
     for request in requests:
-        exists = False
-        for normal in normals:
-            if normal.same_values(request):
-                normals[normal].append(request)
-                exists = True
-                break
-        if not exists:
+        digest = request.values_digest()
+        normal = normal_by_digest.get(digest)
+        if normal is not None:
+            normals[normal].append(request)
+        else:
+            normal_by_digest[digest] = request
             normals[request] = list()
 
     return normals
@@ -58,7 +133,8 @@ def save_normalized_requests(normalized_requests: dict[Request, list[Request]]):
         requests_normalized.append(NormalizedRequest(normal.req_id, normal.req_id))
         for request in normalized_requests[normal]:
             requests_normalized.append(NormalizedRequest(request.req_id, normal.req_id))
-    result = db.insert_normalized_requests(requests_normalized)
+    with metrics.stage("db_write"):
+        result = db.insert_normalized_requests(requests_normalized)
     print(f"saved all request normalizations: {result}")
 
 
@@ -71,49 +147,184 @@ def get_normals_to_analyze(normals: list[Request], source: str, model: str) -> l
 def analyze_experiment(
         experiment_id: int, batch_size: int,
         match_mode: str, source: str, model: str,
-        only_apps: list[str]):
+        only_apps: list[str], queue: bool = False, lease_seconds: int = LEASE_SECONDS,
+        llm_config: LLMConfig | None = None, writer: BufferedWriter | None = None):
 
     print(f"analyzing {match_mode} requests from experiment {experiment_id} "
           f"with batch size {batch_size}, model {model}")
     # get requests for experiment (rid, query, content)
     if match_mode == match_modes[0]:
-        requests = db.get_experiment_matched_requests(experiment_id)
-    elif len(only_apps) > 0:
+        requests = db.stream_experiment_matched_requests(experiment_id)
+    elif len(selected_apps(match_mode, only_apps)) > 0:
         requests = db.get_experiment_app_requests(experiment_id, only_apps)
     else:
-        requests = db.get_experiment_requests(experiment_id)
-    print(f"number of requests: {len(requests)}")
-    # normalize requests (host, path, content)
-    normalized_requests = normalize_requests(requests)
+        requests = db.stream_experiment_requests(experiment_id)
+    # normalize requests (host, path, content) while they are streamed in
+    fetched = metrics.TimedIterator(requests, "fetch")
+    start = time.perf_counter()
+    normalized_requests = normalize_requests(fetched)
+    metrics.add_stage_time("normalize", time.perf_counter() - start - fetched.seconds)
+    print(f"number of requests: {sum(1 + len(duplicates) for duplicates in normalized_requests.values())}")
     print(f"number of normalized requests: {len(normalized_requests)}")
     save_normalized_requests(normalized_requests)
     # exclude analyzed requests
     normals = list(normalized_requests.keys())
+    if llm_config is None:
+        llm_config = LLMConfig(model, source)
+    own_writer = writer is None
+    if own_writer:
+        writer = db.buffered_writer()
+    try:
+        if queue:
+            analyze_queue(normals, batch_size, source, model, llm_config, writer, lease_seconds,
+                          experiment_id, analysis_selection(match_mode, only_apps))
+        else:
+            analyze_remaining(normals, batch_size, source, model, llm_config, writer)
+    finally:
+        if own_writer:
+            writer.close()
+
+
+def analyze_remaining(normals: list[Request], batch_size: int, source: str, model: str,
+                      llm_config: LLMConfig, writer: BufferedWriter) -> int:
     normals_to_analyze = get_normals_to_analyze(normals, source, model)
     print(f"remaining number of normals to analyze: {len(normals_to_analyze)}")
     normals_batch = normals_to_analyze[:batch_size]
     print([n.req_id for n in normals_batch])
+    analyze_batch(normals_batch, llm_config, writer)
+    return len(normals_to_analyze) - len(normals_batch)
+
+
+def analyze_batch(normals: list[Request], llm_config: LLMConfig, writer: BufferedWriter, dequeue: bool = False):
+    with metrics.stage("fetch_contents"):
+        db.load_contents(normals)
+    with metrics.stage("llm"):
+        _analyze_batch(normals, llm_config, writer, dequeue)
+    if llm_config.cache is not None:
+        print(llm_config.cache)
+    if llm_config.extractor is not None:
+        print(llm_config.extractor)
+
+
+def _analyze_batch(normals: list[Request], llm_config: LLMConfig, writer: BufferedWriter, dequeue: bool):
+    if llm_config.concurrency > 1:
+        asyncio.run(analyze_batch_async(normals, llm_config, writer, dequeue))
+    elif llm_config.pack:
+        llm = LLM(llm_config.model, llm_config.source, llm_config.cache, llm_config.extractor)
+        prompts = [(n, prompt) for n in normals for prompt in request_prompts(n)]
+        answers = llm.get_private_data_batch([prompt for _, prompt in prompts])
+        save_batch_private_data(normals, prompts, answers, llm_config, writer, dequeue)
+    else:
+        llm = LLM(llm_config.model, llm_config.source, llm_config.cache, llm_config.extractor)
+        for normalized_request in tqdm(normals):
+            private_data: list[PrivateData] = list()
+            for prompt in request_prompts(normalized_request):
+                private_data += llm.get_private_data(prompt)
+            save_private_data(normalized_request, private_data, llm_config, writer, dequeue)
+
+
+async def analyze_batch_async(normals: list[Request], llm_config: LLMConfig, writer: BufferedWriter,
+                              dequeue: bool = False):
+    llm = AsyncLLM(llm_config.model, llm_config.source, llm_config.concurrency,
+                   llm_config.requests_per_minute, llm_config.tokens_per_minute, llm_config.cache,
+                   llm_config.extractor)
+
+    async def analyze(normalized_request: Request) -> tuple[Request, list[PrivateData]]:
+        answers = await asyncio.gather(*[llm.get_private_data(p) for p in request_prompts(normalized_request)])
+        return normalized_request, [data for answer in answers for data in answer]
+
+    try:
+        if llm_config.pack:
+            prompts = [(n, prompt) for n in normals for prompt in request_prompts(n)]
+            answers = await llm.get_private_data_batch([prompt for _, prompt in prompts])
+            save_batch_private_data(normals, prompts, answers, llm_config, writer, dequeue)
+            return
+        # results are saved from the event loop as they come in, the llm calls keep running meanwhile
+        for analyzed in tqdm(asyncio.as_completed([analyze(n) for n in normals]), total=len(normals)):
+            normalized_request, private_data = await analyzed
+            save_private_data(normalized_request, private_data, llm_config, writer, dequeue)
+    finally:
+        await llm.close()
+
+
+def selected_apps(match_mode: str, only_apps: list[str]) -> list[str]:
+    # the tracking mode analyzes the matched requests of all apps
+    return only_apps if match_mode == match_modes[1] else []
+
+
+def analysis_selection(match_mode: str, only_apps: list[str]) -> str:
+    # the requests normalized and analyzed depend on the match mode and the apps
+    only_apps = selected_apps(match_mode, only_apps)
+    if len(only_apps) == 0:
+        return match_mode
+    apps = hashlib.md5("\n".join(sorted(set(only_apps))).encode("utf-8")).hexdigest()[:12]
+    return f"{match_mode}:apps={apps}"
+
+
+def analyze_queue(normals: list[Request], batch_size: int, source: str, model: str,
+                  llm_config: LLMConfig, writer: BufferedWriter, lease_seconds: int,
+                  experiment_id: int, selection: str):
+    # every worker enqueues the normals of the experiment, the queue only keeps those not analyzed yet.
+    # Workers only claim the requests of their own experiment and selection.
+    db.ensure_llm_queue()
+    enqueued = db.enqueue_normalized_requests(experiment_id, selection, [n.req_id for n in normals], source, model)
+    print(f"enqueued {enqueued} normalized requests")
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    normals_by_id = {n.req_id: n for n in normals}
+    while True:
+        claimed = db.claim_normalized_requests(worker, experiment_id, selection, source, model, batch_size,
+                                               lease_seconds)
+        if len(claimed) == 0:
+            print(f"{worker}: work queue is empty")
+            break
+        print(f"{worker}: claimed {claimed}")
+        batch: list[Request] = list()
+        for request_id in claimed:
+            normalized_request = normals_by_id.get(request_id)
+            if normalized_request is None:
+                # enqueued by a worker whose requests of the same selection differ, e.g. a newer run
+                print(f"{request_id}: not part of this analysis, leaving it to its lease", file=sys.stderr)
+            else:
+                batch.append(normalized_request)
+        analyze_batch(batch, llm_config, writer, dequeue=True)
+        # the next claim must not hand out requests whose results are still buffered
+        writer.flush()
+
+
+def request_prompts(normalized_request: Request) -> list[str]:
     # ask chatgpt for private data in query (if exists) or content
-    llm = LLM(model, source)
-    for normalized_request in tqdm(normals_batch):
-        private_data: list[PrivateData] = list()
-        query_split = normalized_request.path.split("?")[1:]
-        if len(query_split) == 1 and query_split[0] != "":
-            query = query_split[0]
-            print(query)
-            private_data += llm.get_private_data(query)
-        else:
-            print(f"{normalized_request.req_id}: no query string")
-        if normalized_request.content != "":
-            private_data += llm.get_private_data(normalized_request.content)
-        else:
-            print(f"{normalized_request.req_id}: no content")
-        # insert responses for request in separate table
-        print(f"found {len(private_data)} raw pairs of private data")
-        private_data = deduplicate_private_data(private_data)
-        print(f"after normalization there are {len(private_data)} pairs of private data")
-        db.insert_private_data(normalized_request, private_data)
-        db.set_normalized_request_analyzed(normalized_request.req_id, source, model)
+    prompts: list[str] = list()
+    query_split = normalized_request.path.split("?")[1:]
+    if len(query_split) == 1 and query_split[0] != "":
+        query = query_split[0]
+        print(query)
+        prompts.append(query)
+    else:
+        print(f"{normalized_request.req_id}: no query string")
+    if normalized_request.content != "":
+        prompts.append(normalized_request.content)
+    else:
+        print(f"{normalized_request.req_id}: no content")
+    return prompts
+
+
+def save_batch_private_data(normals: list[Request], prompts: list[tuple[Request, str]],
+                            answers: list[list[PrivateData]], llm_config: LLMConfig,
+                            writer: BufferedWriter, dequeue: bool = False):
+    private_data: dict[int, list[PrivateData]] = {n.req_id: list() for n in normals}
+    for (normalized_request, _), answer in zip(prompts, answers):
+        private_data[normalized_request.req_id] += answer
+    for normalized_request in tqdm(normals):
+        save_private_data(normalized_request, private_data[normalized_request.req_id], llm_config, writer, dequeue)
+
+
+def save_private_data(normalized_request: Request, private_data: list[PrivateData], llm_config: LLMConfig,
+                      writer: BufferedWriter, dequeue: bool = False):
+    # insert responses for request in separate table, buffered by the writer
+    print(f"found {len(private_data)} raw pairs of private data")
+    private_data = deduplicate_private_data(private_data)
+    print(f"after normalization there are {len(private_data)} pairs of private data")
+    writer.add(normalized_request, private_data, llm_config.source, llm_config.model, dequeue)
 
 
 if __name__ == '__main__':
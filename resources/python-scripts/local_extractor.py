@@ -0,0 +1,96 @@
+import json
+import re
+from pathlib import Path
+from urllib.parse import parse_qsl
+from xml.etree import ElementTree
+
+from private_data import PrivateData
+
+LOCAL_MODEL = "local-extractor"
+DEFAULT_CONFIG = Path(__file__).with_name("local_extractor.json")
+KEY_CHARACTERS = re.compile(r"[^a-z0-9]")
+
+
+def normalize_key(key: str) -> str:
+    return KEY_CHARACTERS.sub("", key.lower())
+
+
+def parse_payload(payload: str) -> list[tuple[str, str]] | None:
+    # flattened (key, value) pairs of a json, form encoded or xml payload, None for any other format
+    stripped = payload.strip()
+    if stripped.startswith("{") or stripped.startswith("["):
+        try:
+            return _flatten_json(json.loads(stripped))
+        except ValueError:
+            return None
+    if stripped.startswith("<"):
+        try:
+            return _flatten_xml(ElementTree.fromstring(stripped))
+        except ElementTree.ParseError:
+            return None
+    if "=" in stripped and not any(c.isspace() for c in stripped):
+        try:
+            return parse_qsl(stripped, keep_blank_values=True, strict_parsing=True)
+        except ValueError:
+            return None
+    return None
+
+
+def _flatten_json(value, path: str = "") -> list[tuple[str, str]]:
+    if isinstance(value, dict):
+        return [pair for key, item in value.items() for pair in _flatten_json(item, f"{path}.{key}" if path else key)]
+    if isinstance(value, list):
+        return [pair for i, item in enumerate(value) for pair in _flatten_json(item, f"{path}[{i}]")]
+    if value is None:
+        return []
+    if isinstance(value, bool):
+        return [(path, "true" if value else "false")]
+    return [(path, str(value))]
+
+
+def _flatten_xml(element: ElementTree.Element, path: str = "") -> list[tuple[str, str]]:
+    path = f"{path}.{element.tag}" if path else element.tag
+    pairs = [(f"{path}.{key}", value) for key, value in element.attrib.items()]
+    children = list(element)
+    if len(children) == 0:
+        if element.text is not None and element.text.strip() != "":
+            pairs.append((path, element.text.strip()))
+    for child in children:
+        pairs += _flatten_xml(child, path)
+    return pairs
+
+
+class LocalExtractor:
+    def __init__(self, config_path: Path = DEFAULT_CONFIG):
+        with open(config_path) as f:
+            config = json.load(f)
+        self.categories: dict[str, str] = {normalize_key(k): v for k, v in config["categories"].items()}
+        self.ignore: set[str] = {normalize_key(k) for k in config["ignore"]}
+        self.min_coverage: float = config["minCoverage"]
+        self.resolved = 0
+        self.unresolved = 0
+
+    def extract(self, payload: str, source: str) -> list[PrivateData] | None:
+        # None if the payload has to be analyzed by the llm
+        pairs = parse_payload(payload)
+        if pairs is None or len(pairs) == 0:
+            self.unresolved += 1
+            return None
+        private_data: list[PrivateData] = []
+        known = 0
+        for key, value in pairs:
+            # the innermost key decides, e.g. device.os or device[0].os
+            leaf = normalize_key(re.split(r"[.\[]", key)[-1].rstrip("]"))
+            if leaf in self.categories:
+                private_data.append(PrivateData(self.categories[leaf], key, value, source, LOCAL_MODEL))
+                known += 1
+            elif leaf in self.ignore:
+                known += 1
+        if known / len(pairs) < self.min_coverage:
+            self.unresolved += 1
+            return None
+        self.resolved += 1
+        return private_data
+
+    def __str__(self):
+        return f"local extractor: {self.resolved} payloads resolved, {self.unresolved} left to the llm"
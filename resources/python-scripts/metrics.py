@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, TypeVar
+
+PREFIX = "plotalyzer"
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+T = TypeVar("T")
+Labels = tuple[tuple[str, str], ...]
+
+_lock = threading.RLock()
+_counters: dict[tuple[str, Labels], float] = dict()
+_histograms: dict[tuple[str, Labels], "Histogram"] = dict()
+_jsonl_path: Path | None = None
+_prometheus_path: Path | None = None
+_run: str = ""
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def mean(self) -> float:
+        return self.sum / max(self.count, 1)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--metrics-jsonl", type=Path, default=os.environ.get("METRICS_JSONL"),
+                        help="append stage timings and llm calls to this json lines file")
+    parser.add_argument("--metrics-prom", type=Path, default=os.environ.get("METRICS_PROM"),
+                        help="write the metrics of the run to this prometheus textfile")
+
+
+def configure(run: str, jsonl_path: Path | None = None, prometheus_path: Path | None = None) -> None:
+    global _run, _jsonl_path, _prometheus_path
+    _run = run
+    _jsonl_path = None if jsonl_path is None else Path(jsonl_path)
+    _prometheus_path = None if prometheus_path is None else Path(prometheus_path)
+
+
+def configure_from_args(run: str, args: argparse.Namespace) -> None:
+    configure(run, args.metrics_jsonl, args.metrics_prom)
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def event(kind: str, **fields) -> None:
+    if _jsonl_path is None:
+        return
+    line = json.dumps({"time": time.time(), "run": _run, "event": kind, **fields})
+    with _lock:
+        with open(_jsonl_path, "a") as f:
+            f.write(line + "\n")
+
+
+def count(name: str, amount: float = 1, **labels) -> None:
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels) -> None:
+    key = (name, _labels(labels))
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].observe(value)
+
+
+def add_stage_time(name: str, seconds: float) -> None:
+    count("stage_seconds", seconds, stage=name)
+    count("stage_runs", 1, stage=name)
+    event("stage", stage=name, seconds=round(seconds, 6))
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(name, time.perf_counter() - start)
+
+
+class TimedIterator:
+    # the time spent producing the items, e.g. fetching rows from a cursor, without the time of the consumer
+    def __init__(self, iterable: Iterable[T], name: str):
+        self.iterator = iter(iterable)
+        self.name = name
+        self.seconds = 0.0
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> T:
+        start = time.perf_counter()
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            if not self.done:
+                self.done = True
+                add_stage_time(self.name, self.seconds + time.perf_counter() - start)
+            raise
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def record_llm_call(model: str, seconds: float, usage) -> None:
+    observe("llm_latency_seconds", seconds, model=model)
+    count("llm_calls", 1, model=model)
+    prompt_tokens = 0 if usage is None else usage.prompt_tokens
+    completion_tokens = 0 if usage is None else usage.completion_tokens
+    count("llm_tokens", prompt_tokens, model=model, kind="prompt")
+    count("llm_tokens", completion_tokens, model=model, kind="completion")
+    event("llm_call", model=model, seconds=round(seconds, 6), prompt_tokens=prompt_tokens,
+          completion_tokens=completion_tokens)
+
+
+def _by_label(name: str, label: str) -> dict[str, float]:
+    values: dict[str, float] = dict()
+    for (counter, labels), value in _counters.items():
+        if counter == name:
+            key = dict(labels).get(label, "")
+            values[key] = values.get(key, 0) + value
+    return values
+
+
+def summary() -> str:
+    with _lock:
+        lines = [f"metrics of {_run}:"]
+        runs = _by_label("stage_runs", "stage")
+        for name, seconds in sorted(_by_label("stage_seconds", "stage").items(), key=lambda s: -s[1]):
+            lines.append(f"  {name}: {seconds:.3f}s in {int(runs.get(name, 0))} runs")
+        for (name, labels), histogram in sorted(_histograms.items()):
+            model = dict(labels).get("model", "")
+            tokens = {dict(l).get("kind"): v for (c, l), v in _counters.items()
+                      if c == "llm_tokens" and dict(l).get("model") == model}
+            lines.append(f"  {model}: {histogram.count} calls, {histogram.mean():.3f}s mean latency, "
+                         f"{int(tokens.get('prompt', 0))} prompt and {int(tokens.get('completion', 0))} "
+                         f"completion tokens")
+        for name in ("llm_retries", "llm_fallbacks", "llm_errors"):
+            total = sum(_by_label(name, "model").values())
+            if total > 0:
+                lines.append(f"  {name.replace('_', ' ')}: {int(total)}")
+        return "\n".join(lines)
+
+
+def _prometheus_labels(labels: Labels, extra: tuple[tuple[str, str], ...] = ()) -> str:
+    pairs = (("run", _run),) + labels + extra
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def prometheus_text() -> str:
+    with _lock:
+        lines: list[str] = []
+        for name in sorted({name for name, _ in _counters}):
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            for (counter, labels), value in sorted(_counters.items()):
+                if counter == name:
+                    lines.append(f"{PREFIX}_{name}_total{_prometheus_labels(labels)} {value}")
+        for name in sorted({name for name, _ in _histograms}):
+            lines.append(f"# TYPE {PREFIX}_{name} histogram")
+            for (histogram_name, labels), histogram in sorted(_histograms.items()):
+                if histogram_name != name:
+                    continue
+                for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f"{PREFIX}_{name}_bucket{_prometheus_labels(labels, (('le', str(bound)),))} "
+                                 f"{bucket_count}")
+                lines.append(f"{PREFIX}_{name}_bucket{_prometheus_labels(labels, (('le', '+Inf'),))} "
+                             f"{histogram.count}")
+                lines.append(f"{PREFIX}_{name}_sum{_prometheus_labels(labels)} {histogram.sum}")
+                lines.append(f"{PREFIX}_{name}_count{_prometheus_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def finish() -> None:
+    # the textfile is replaced atomically, as the node exporter may read it at any time
+    print(summary())
+    event("summary", counters={f"{name}{dict(labels)}": value for (name, labels), value in _counters.items()})
+    if _prometheus_path is not None:
+        tmp_path = _prometheus_path.with_suffix(".tmp")
+        tmp_path.write_text(prometheus_text())
+        tmp_path.replace(_prometheus_path)
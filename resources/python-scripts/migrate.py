@@ -0,0 +1,225 @@
+import argparse
+
+import psycopg2
+from psycopg2.sql import SQL
+
+import adblock_addon
+import database
+import db_pool
+from database import CONTENT_DIGEST, Database
+from experiment_view import ANALYSES_QUERY, REFRESH_TABLE, REQUEST_TABLE, REQUESTS_STATE_QUERY, SCHEMA
+
+# (name, table, columns) of the indexes the experiment queries, the anti-joins and the result lookups use
+INDEXES = [("interfaceanalysis_experiment_idx", "interfaceanalysis", "(experiment, id)"),
+           ("trafficcollection_analysis_idx", "trafficcollection", "(analysis, id)"),
+           ("request_run_idx", "request", "(run)"),
+           ("request_llm_analyzed_source_model_idx", "pluginadblock.request_llm_analyzed",
+            "(source, model, request_id)"),
+           ("requestmatch_list_version_idx", "pluginadblock.requestmatch", "(list_id, list_version, request_id)"),
+           ("requestmatch_matched_idx", "pluginadblock.requestmatch", "(request_id) WHERE match IS true")]
+MATERIALIZE_QUERY = (f"INSERT INTO {REQUEST_TABLE} "
+                     f"(experiment, request_id, analysis, app_id, scheme, host, path, content_digest, analyzable) "
+                     f"SELECT ia.experiment, r.id, ia.id, ia.app_id, r.scheme, r.host, r.path, {CONTENT_DIGEST}, "
+                     f"r.error IS Null AND ia.success IS true "
+                     f"FROM interfaceanalysis ia "
+                     f"INNER JOIN trafficcollection tc on tc.analysis = ia.id "
+                     f"INNER JOIN request r on r.run = tc.id "
+                     f"WHERE ia.experiment = %s AND r.id > %s "
+                     f"ON CONFLICT DO NOTHING;")
+NORMALIZED_PROBE_QUERY = ("SELECT v.rid "
+                          "FROM ( SELECT r.id FROM interfaceanalysis ia "
+                          "       INNER JOIN trafficcollection tc on tc.analysis = ia.id "
+                          "       INNER JOIN request r on r.run = tc.id "
+                          "       WHERE ia.experiment = %s ) AS v (rid) "
+                          "WHERE NOT EXISTS "
+                          "( SELECT request_id FROM request_normalized "
+                          "  WHERE request_id = v.rid);")
+PRIVATE_DATA_PROBE_QUERY = ("SELECT v.rid "
+                            "FROM ( SELECT request_id, category, key, value, source, model FROM private_data "
+                            "       LIMIT 1000 ) AS v (rid, category, key, value, source, model) "
+                            "WHERE NOT EXISTS "
+                            "( SELECT request_id FROM private_data "
+                            "  WHERE request_id = v.rid AND category = v.category "
+                            "    AND key = v.key AND value = v.value AND source = v.source"
+                            "    AND model = v.model);")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="create the indexes and unique constraints of the analysis queries "
+                                                 "and materialize the requests of experiments")
+    parser.add_argument("experiment_ids", type=int, nargs="*", help="experiments to materialize or refresh")
+    parser.add_argument("--all-experiments", action="store_true", help="materialize or refresh every experiment")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="materialize the experiments again even if they did not change")
+    parser.add_argument("--no-view", action="store_true", help="only create the indexes and constraints")
+    parser.add_argument("--explain", type=int, default=None, metavar="EXPERIMENT_ID",
+                        help="print the EXPLAIN ANALYZE timings of the queries of this experiment "
+                             "before and after the migration")
+    db_pool.add_arguments(parser)
+    args = parser.parse_args()
+    db_pool.configure_from_args(args)
+
+    migration = SchemaMigration()
+    try:
+        before = migration.explain(args.explain) if args.explain is not None else None
+        migration.create_indexes()
+        migration.create_constraints()
+        if not args.no_view:
+            migration.create_view()
+            experiment_ids = migration.get_experiment_ids() if args.all_experiments else args.experiment_ids
+            if args.explain is not None and args.explain not in experiment_ids:
+                experiment_ids = experiment_ids + [args.explain]
+            for experiment_id in experiment_ids:
+                migration.refresh(experiment_id, args.rebuild)
+        if before is not None:
+            after = migration.explain(args.explain)
+            print(f"EXPLAIN ANALYZE execution times of experiment {args.explain} in ms, before -> after:")
+            for name, milliseconds in before.items():
+                print(f"  {name}: {_milliseconds(milliseconds)} -> {_milliseconds(after[name])}")
+    finally:
+        migration.close()
+        db_pool.close()
+
+
+def _milliseconds(milliseconds: float | None) -> str:
+    return "-" if milliseconds is None else f"{milliseconds:.1f}"
+
+
+class SchemaMigration(Database):
+
+    def _table_exists(self, table: str) -> bool:
+        self.cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+        exists = self.cur.fetchone()[0]
+        self.conn.commit()
+        return exists
+
+    def create_indexes(self) -> None:
+        for name, table, columns in INDEXES:
+            if not self._table_exists(table):
+                print(f"skipping index {name}, {table} does not exist")
+                continue
+            print(f"creating index {name} on {table} {columns}")
+            self.cur.execute(SQL(f"CREATE INDEX IF NOT EXISTS {name} ON {table} {columns};"))
+            self.conn.commit()
+
+    def create_constraints(self) -> None:
+        # the anti-joins probe request_normalized by request id, every request is normalized once
+        try:
+            self.cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS request_normalized_request_id_unique "
+                             "ON request_normalized (request_id);")
+            self.conn.commit()
+        except psycopg2.Error as e:
+            self.conn.rollback()
+            print(f"request_normalized has duplicate request ids, creating a non unique index instead: {e}")
+            self.cur.execute("CREATE INDEX IF NOT EXISTS request_normalized_request_id_idx "
+                             "ON request_normalized (request_id);")
+            self.conn.commit()
+        if self.ensure_private_data_constraints():
+            print("created the unique constraints of private_data and request_llm_analyzed")
+
+    def create_view(self) -> None:
+        self.cur.execute(SQL(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA};"))
+        self.cur.execute(SQL(f"CREATE TABLE IF NOT EXISTS {REQUEST_TABLE} ("
+                             f" experiment integer NOT NULL ,"
+                             f" request_id integer NOT NULL REFERENCES public.request(id) "
+                             f"  ON UPDATE CASCADE ON DELETE CASCADE ,"
+                             f" analysis integer NOT NULL ,"
+                             f" app_id varchar ,"
+                             f" scheme varchar ,"
+                             f" host varchar ,"
+                             f" path varchar ,"
+                             f" content_digest varchar NOT NULL ,"
+                             f" analyzable boolean NOT NULL ,"
+                             f" PRIMARY KEY (experiment, request_id)"
+                             f");"))
+        self.cur.execute(SQL(f"CREATE TABLE IF NOT EXISTS {REFRESH_TABLE} ("
+                             f" experiment integer NOT NULL PRIMARY KEY ,"
+                             f" analyses integer NOT NULL ,"
+                             f" successful_analyses integer NOT NULL ,"
+                             f" max_request_id integer NOT NULL ,"
+                             f" requests integer NOT NULL ,"
+                             f" refreshed_at timestamp with time zone NOT NULL DEFAULT now()"
+                             f");"))
+        self.conn.commit()
+
+    def get_experiment_ids(self) -> list[int]:
+        self.cur.execute("SELECT DISTINCT experiment FROM interfaceanalysis ORDER BY experiment;")
+        self.conn.commit()
+        return [r[0] for r in self.cur.fetchall()]
+
+    def refresh(self, experiment_id: int, rebuild: bool = False) -> None:
+        # Experiments whose analyses did not change only get their new requests appended. Requests
+        # committed out of id order, e.g. by parallel collectors, show up in the request count, upon
+        # which the experiment is materialized again.
+        self.cur.execute(ANALYSES_QUERY, (experiment_id,))
+        analyses, successful_analyses = self.cur.fetchone()
+        self.cur.execute(REQUESTS_STATE_QUERY, (experiment_id,))
+        max_request_id, requests = self.cur.fetchone()
+        self.cur.execute(SQL(f"SELECT analyses, successful_analyses, max_request_id, requests "
+                             f"FROM {REFRESH_TABLE} "
+                             f"WHERE experiment = %s;"), (experiment_id,))
+        refreshed = self.cur.fetchone()
+        state = (analyses, successful_analyses, max_request_id, requests)
+        if refreshed == state and not rebuild:
+            self.conn.commit()
+            print(f"experiment {experiment_id}: up to date with {requests} requests")
+            return
+        appended = None
+        if refreshed is not None and refreshed[:2] == state[:2] and not rebuild:
+            self.cur.execute(MATERIALIZE_QUERY, (experiment_id, refreshed[2]))
+            appended = self.cur.rowcount
+            if refreshed[3] + appended != requests:
+                appended = None
+        if appended is None:
+            self.cur.execute(SQL(f"DELETE FROM {REQUEST_TABLE} WHERE experiment = %s;"), (experiment_id,))
+            self.cur.execute(MATERIALIZE_QUERY, (experiment_id, 0))
+        self.cur.execute(SQL(f"INSERT INTO {REFRESH_TABLE} "
+                             f"(experiment, analyses, successful_analyses, max_request_id, requests) "
+                             f"VALUES (%s, %s, %s, %s, %s) "
+                             f"ON CONFLICT (experiment) DO UPDATE "
+                             f"SET analyses = EXCLUDED.analyses, successful_analyses = EXCLUDED.successful_analyses, "
+                             f"max_request_id = EXCLUDED.max_request_id, requests = EXCLUDED.requests, "
+                             f"refreshed_at = now();"), (experiment_id, *state))
+        self.conn.commit()
+        if appended is None:
+            print(f"experiment {experiment_id}: materialized {requests} requests")
+        else:
+            print(f"experiment {experiment_id}: appended {appended} requests")
+
+    def explain(self, experiment_id: int) -> dict[str, float | None]:
+        # the view queries are used once the experiment is materialized, as by the analysis scripts
+        use_view = self._table_exists(REFRESH_TABLE)
+        if use_view:
+            self.cur.execute(SQL(f"SELECT 1 FROM {REFRESH_TABLE} WHERE experiment = %s;"), (experiment_id,))
+            use_view = self.cur.fetchone() is not None
+            self.conn.commit()
+        queries = {"llm requests": (database.EXPERIMENT_REQUESTS_QUERY, database.VIEW_REQUESTS_QUERY),
+                   "llm tracking requests": (database.EXPERIMENT_MATCHED_REQUESTS_QUERY,
+                                             database.VIEW_MATCHED_REQUESTS_QUERY),
+                   "pipeline requests": (database.EXPERIMENT_PIPELINE_REQUESTS_QUERY,
+                                         database.VIEW_PIPELINE_REQUESTS_QUERY),
+                   "adblock requests": (adblock_addon.EXPERIMENT_REQUESTS_QUERY, adblock_addon.VIEW_REQUESTS_QUERY),
+                   "request_normalized anti-join": (NORMALIZED_PROBE_QUERY, NORMALIZED_PROBE_QUERY)}
+        timings: dict[str, float | None] = {name: self._explain(view_query if use_view else query, (experiment_id,))
+                                            for name, (query, view_query) in queries.items()}
+        timings["private_data anti-join"] = self._explain(PRIVATE_DATA_PROBE_QUERY, None)
+        return timings
+
+    def _explain(self, query: str, params) -> float | None:
+        # the second of two runs, so both sides are measured with warm caches
+        milliseconds = None
+        for _ in range(2):
+            try:
+                self.cur.execute(SQL(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}"), params)
+                milliseconds = self.cur.fetchone()[0][0]["Execution Time"]
+            except psycopg2.Error as e:
+                print(f"could not explain query: {e}")
+                milliseconds = None
+                break
+            finally:
+                self.conn.rollback()
+        return milliseconds
+
+
+if __name__ == '__main__':
+    main()
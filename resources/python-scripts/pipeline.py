@@ -0,0 +1,218 @@
+import argparse
+import sys
+import time
+import traceback
+from typing import Iterator
+
+import db_pool
+import metrics
+from adblock_addon import AdBlockAddon, MatchRun, parse_filter_list_names
+from adblock_engine import ENGINES
+from database import BufferedWriter, Database
+from llm import gpt4
+from llm_traffic_analysis import (LLMConfig, LEASE_SECONDS, add_analysis_arguments, analysis_selection, analyze_queue,
+                                  analyze_remaining, db, get_normals_to_analyze, llm_config_from_args, match_modes,
+                                  normalize_requests, read_only_file, save_normalized_requests, selected_apps)
+from request import Request
+
+STAGES = ("adblock", "normalize", "llm")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fetch the requests of experiments once and run adblock matching, "
+                                                 "normalization and the llm analysis on them")
+    parser.add_argument("experiment_ids", type=int, nargs="+")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"comma separated stages to run, of {', '.join(STAGES)}")
+    parser.add_argument("--restart", action="store_true",
+                        help="run the selected stages again even if their checkpoint says they are done")
+    parser.add_argument("--filter-lists", default="all", help="a filter list name, comma separated names or 'all'")
+    parser.add_argument("--engine", choices=ENGINES, default=ENGINES[0], help="adblock matching engine")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used for matching")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="stream the requests from a server side cursor in chunks of this size")
+    parser.add_argument("--match-mode", choices=match_modes, default=match_modes[0],
+                        help="analyze only the requests matched by a filter list or all of them")
+    parser.add_argument("--source", default=None, help="source of the llm results, required by the llm stage")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="number of normalized requests to analyze per experiment, by default all, "
+                             "or to claim at once in queue mode")
+    parser.add_argument("--only-file", default=None,
+                        help="file with the app ids to analyze, the tracking mode analyzes all apps")
+    add_analysis_arguments(parser)
+    db_pool.add_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip() != ""]
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage}, choose from {', '.join(STAGES)}")
+    if "llm" in stages and args.source is None:
+        parser.error("the llm stage requires --source")
+    if args.queue and args.batch_size is None:
+        parser.error("queue mode requires --batch-size")
+    db_pool.configure_from_args(args)
+    metrics.configure_from_args(f"pipeline:{','.join(str(e) for e in args.experiment_ids)}", args)
+
+    addon = None
+    writer = None
+    failed: list[int] = []
+    try:
+        if "adblock" in stages:
+            addon = AdBlockAddon(parse_filter_list_names(args.filter_lists), workers=args.workers,
+                                 engine=args.engine)
+        only_apps = [] if args.only_file is None else read_only_file(args.only_file)
+        llm_config = llm_config_from_args(gpt4, args.source, args) if "llm" in stages else None
+        writer = db.buffered_writer(args.flush_requests, args.flush_seconds) if "llm" in stages else None
+        pipeline = Pipeline(db, stages, addon, args.match_mode, only_apps, args.chunk_size, args.batch_size,
+                            args.queue, args.lease, llm_config, writer)
+        db.ensure_pipeline_checkpoints()
+        for experiment_id in args.experiment_ids:
+            if args.restart:
+                print(f"experiment {experiment_id}: {db.delete_pipeline_checkpoints(experiment_id, stages)} "
+                      f"checkpoints removed")
+            try:
+                pipeline.run(experiment_id)
+            except Exception:
+                # the checkpoints of the finished stages let the next run resume the experiment
+                traceback.print_exc()
+                print(f"experiment {experiment_id} failed, continuing with the next one", file=sys.stderr)
+                failed.append(experiment_id)
+    finally:
+        if writer is not None:
+            writer.close()
+        if addon is not None:
+            addon.close()
+        db.close()
+        db_pool.close()
+        metrics.finish()
+    if len(failed) > 0:
+        print(f"failed experiments: {failed}", file=sys.stderr)
+        sys.exit(1)
+
+
+class Pipeline:
+    # Runs the selected stages on the requests of an experiment fetched in a single query, either all at
+    # once or chunk by chunk. Every chunk is matched against the filter lists before its requests are
+    # normalized, so the tracking mode uses the matches of this run instead of reading them back. A stage
+    # records a checkpoint per experiment and configuration once done and is skipped while it exists.
+    def __init__(self, db: Database, stages: list[str], addon: AdBlockAddon | None, match_mode: str,
+                 only_apps: list[str], chunk_size: int | None = None, batch_size: int | None = None,
+                 queue: bool = False, lease_seconds: int = LEASE_SECONDS, llm_config: LLMConfig | None = None,
+                 writer: BufferedWriter | None = None):
+        self.db = db
+        self.stages = stages
+        self.addon = addon
+        self.match_mode = match_mode
+        # the same apps as selected by llm_traffic_analysis, so both share checkpoints and the queue
+        self.only_apps = set(selected_apps(match_mode, only_apps))
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.queue = queue
+        self.lease_seconds = lease_seconds
+        self.llm_config = llm_config
+        self.writer = writer
+
+    def selection(self) -> str:
+        return analysis_selection(self.match_mode, sorted(self.only_apps))
+
+    def checkpoint_configs(self, list_versions: dict[str, tuple[int, int]]) -> dict[str, list[str]]:
+        configs: dict[str, list[str]] = dict()
+        if "adblock" in self.stages:
+            configs["adblock"] = [f"{name}:{version}" for name, (_, version) in list_versions.items()]
+        if "normalize" in self.stages:
+            configs["normalize"] = [self.selection()]
+        if "llm" in self.stages:
+            configs["llm"] = [f"{self.selection()}:{self.llm_config.source}:{self.llm_config.model}"]
+        return configs
+
+    def run(self, experiment_id: int) -> None:
+        list_versions = self.addon.list_versions() if "adblock" in self.stages else dict()
+        configs = self.checkpoint_configs(list_versions)
+        done = self.db.get_pipeline_checkpoints(experiment_id)
+        pending = {stage: [config for config in stage_configs if (stage, config) not in done]
+                   for stage, stage_configs in configs.items()}
+        for stage, stage_configs in pending.items():
+            if len(stage_configs) == 0:
+                print(f"experiment {experiment_id}: {stage} already done")
+        pending = {stage: stage_configs for stage, stage_configs in pending.items() if len(stage_configs) > 0}
+        if len(pending) == 0:
+            return
+        print(f"experiment {experiment_id}: running {', '.join(pending)}")
+
+        match_run = None
+        if "adblock" in pending:
+            match_run = self.addon.start_run(experiment_id, list_versions={
+                name: versions for name, versions in list_versions.items()
+                if f"{name}:{versions[1]}" in pending["adblock"]})
+        select = "normalize" in pending or "llm" in pending
+        # matches of lists not matched in this run are read from the earlier results
+        matched: set[int] = set()
+        if select and self.match_mode == match_modes[0] \
+                and len(pending.get("adblock", [])) < len(configs.get("adblock", [None])):
+            matched = self.db.get_experiment_matched_request_ids(experiment_id)
+
+        chunks = metrics.TimedIterator(self.db.stream_experiment_pipeline_requests(experiment_id, self.chunk_size),
+                                       "fetch")
+        timings = {"adblock": 0.0}
+        start = time.perf_counter()
+        try:
+            normalized_requests = normalize_requests(self._select(chunks, match_run, matched, select, timings))
+        finally:
+            if match_run is not None:
+                match_run.close()
+        metrics.add_stage_time("normalize", time.perf_counter() - start - chunks.seconds - timings["adblock"])
+        if match_run is not None:
+            for config in pending["adblock"]:
+                self._checkpoint(experiment_id, "adblock", config)
+        if not select:
+            return
+
+        print(f"number of requests: {sum(1 + len(duplicates) for duplicates in normalized_requests.values())}")
+        print(f"number of normalized requests: {len(normalized_requests)}")
+        if "normalize" in pending:
+            save_normalized_requests(normalized_requests)
+            self._checkpoint(experiment_id, "normalize", pending["normalize"][0])
+        if "llm" in pending:
+            if self._analyze(experiment_id, list(normalized_requests.keys())) == 0:
+                self._checkpoint(experiment_id, "llm", pending["llm"][0])
+
+    def _select(self, chunks: Iterator[list[tuple[Request, str, bool]]], match_run: MatchRun | None,
+                matched: set[int], select: bool, timings: dict[str, float]) -> Iterator[Request]:
+        # the requests the llm analysis covers, after their chunk has been matched
+        for chunk in chunks:
+            if match_run is not None:
+                start = time.perf_counter()
+                matched.update(match_run.match_chunk([request for request, _, _ in chunk]))
+                timings["adblock"] += time.perf_counter() - start
+            if not select:
+                continue
+            for request, app_id, analyzable in chunk:
+                if not analyzable or (len(self.only_apps) > 0 and app_id not in self.only_apps):
+                    continue
+                if self.match_mode == match_modes[0] and request.req_id not in matched:
+                    continue
+                yield request
+
+    def _analyze(self, experiment_id: int, normals: list[Request]) -> int:
+        # the number of normalized requests that are still not analyzed
+        source, model = self.llm_config.source, self.llm_config.model
+        if self.queue:
+            analyze_queue(normals, self.batch_size, source, model, self.llm_config, self.writer, self.lease_seconds,
+                          experiment_id, self.selection())
+            remaining = len(get_normals_to_analyze(normals, source, model))
+        else:
+            batch_size = len(normals) if self.batch_size is None else self.batch_size
+            remaining = analyze_remaining(normals, batch_size, source, model, self.llm_config, self.writer)
+            self.writer.flush()
+        print(f"{remaining} normalized requests left to analyze")
+        return remaining
+
+    def _checkpoint(self, experiment_id: int, stage: str, config: str) -> None:
+        self.db.set_pipeline_checkpoint(experiment_id, stage, config)
+        metrics.event("checkpoint", experiment=experiment_id, stage=stage, config=config)
+        print(f"experiment {experiment_id}: {stage} {config} done")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,17 @@
+from collections import Counter
+
+from request import intern
+
+
 class PrivateData:
+    __slots__ = ("category", "key", "value", "source", "model", "count")
+
     def __init__(self, category: str, key: str, value: str, source: str, model: str, count: int = 1):
-        self.category = category
+        self.category = intern(category)
         self.key = key
         self.value = value
-        self.source = source
-        self.model = model
+        self.source = intern(source)
+        self.model = intern(model)
         self.count = count
 
     def __eq__(self, other):
@@ -22,8 +29,5 @@ class PrivateData:
 
 
 def deduplicate_private_data(private_data: list[PrivateData]) -> list[PrivateData]:
-    normalized_data: set[PrivateData] = set()
-    for date in private_data:
-        data = PrivateData(date.category, date.key, date.value, date.source, date.model, private_data.count(date))
-        normalized_data.add(data)
-    return list(normalized_data)
+    return [PrivateData(date.category, date.key, date.value, date.source, date.model, count)
+            for date, count in Counter(private_data).items()]
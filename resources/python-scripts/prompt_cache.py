@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from private_data import PrivateData
+
+DEFAULT_MAX_ENTRIES = 1_000_000
+DEFAULT_MAX_AGE_DAYS = 90
+
+
+def default_cache_path() -> Path:
+    return Path(os.environ.get("LLM_CACHE_PATH") or Path(__file__).with_name(".llm_cache.sqlite"))
+
+
+class PromptCache:
+    # parsed llm answers keyed by everything that is sent to the api, i.e. the prompt, model,
+    # instructions and sampling parameters, but not the source label of the analysis
+    def __init__(self, path: Path | None = None, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_age_days: float = DEFAULT_MAX_AGE_DAYS):
+        self.path = default_cache_path() if path is None else path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        # shared by the threads analyzing the chunks of large prompts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS prompt_result ("
+                           " key TEXT NOT NULL PRIMARY KEY,"
+                           " rows TEXT NOT NULL,"
+                           " created REAL NOT NULL,"
+                           " accessed REAL NOT NULL"
+                           ")")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS prompt_result_accessed ON prompt_result (accessed)")
+        self._conn.commit()
+        self.evict()
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def key(completion_arguments: dict) -> str:
+        return hashlib.sha256(json.dumps(completion_arguments, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, completion_arguments: dict, source: str, model: str) -> list[PrivateData] | None:
+        key = self.key(completion_arguments)
+        with self._lock:
+            row = self._conn.execute("SELECT rows FROM prompt_result WHERE key = ? AND created >= ?",
+                                     (key, time.time() - self.max_age)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE prompt_result SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return [PrivateData(category, key, value, source, model) for category, key, value in json.loads(row[0])]
+
+    def put(self, completion_arguments: dict, private_data: list[PrivateData]) -> None:
+        now = time.time()
+        rows = json.dumps([(pd.category, pd.key, pd.value) for pd in private_data])
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO prompt_result (key, rows, created, accessed) "
+                               "VALUES (?, ?, ?, ?)", (self.key(completion_arguments), rows, now, now))
+            self._conn.commit()
+
+    def evict(self) -> None:
+        self._conn.execute("DELETE FROM prompt_result WHERE created < ?", (time.time() - self.max_age,))
+        self._conn.execute("DELETE FROM prompt_result WHERE key IN ("
+                           " SELECT key FROM prompt_result ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                           (self.max_entries,))
+        self._conn.commit()
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return (f"prompt cache: {self.hits} hits, {self.misses} misses "
+                f"({(self.hits / max(lookups, 1) * 100):.2f} % hit rate)")
@@ -1,27 +1,64 @@
+import hashlib
+import sys
+
+DIGEST_CHUNK_SIZE = 64 * 1024
+
+
+def intern(value: str | None) -> str | None:
+    # schemes, hosts, categories and model names repeat across millions of records
+    return None if value is None else sys.intern(value)
+
+
 class Request:
+    __slots__ = ("req_id", "scheme", "host", "path", "content", "content_digest", "content_loaded", "match")
 
-    def __init__(self, req_id: str, scheme: str, host: str, path: str, content: str = ""):
+    def __init__(self, req_id: str, scheme: str, host: str, path: str, content: str = "",
+                 content_digest: str | None = None):
         self.req_id = int(req_id)
-        self.scheme = scheme,
-        self.host = host
+        self.scheme = intern(scheme)
+        self.host = intern(host)
         self.path = path
         self.content = "" if content is None else content
+        # set when only a digest of the content was fetched, the content is loaded later if needed
+        self.content_digest = content_digest
+        self.content_loaded = content_digest is None
         self.match = None
 
     def __eq__(self, other):
         return self.req_id == other.req_id and self.match == other.match and self.same_values(other)
 
     def __hash__(self):
-        return hash((self.req_id, self.scheme, self.host, self.path, self.content, self.match))
+        return hash((self.req_id, self.scheme, self.host, self.path, self._content_key(), self.match))
 
     def __repr__(self):
-        return f"Request({self.req_id}: {self.scheme[0]}://{self.host}{self.path}: {self.content[:50]} - {self.match})"
+        return f"Request({self.req_id}: {self.scheme}://{self.host}{self.path}: {self.content[:50]} - {self.match})"
 
     def same_values(self, other) -> bool:
-        return self.scheme == other.scheme and self.host == other.host and self.path == other.path and self.content == other.content
+        return self.scheme == other.scheme and self.host == other.host and self.path == other.path and self._content_key() == other._content_key()
+
+    def _content_key(self) -> str:
+        return self.content if self.content_digest is None else self.content_digest
+
+    def load_content(self, content: str | None) -> None:
+        self.content = "" if content is None else content
+        self.content_loaded = True
+
+    def values_digest(self) -> bytes:
+        # equal for requests with the same_values, without keeping the content around as a key
+        digest = hashlib.blake2b(digest_size=16)
+        for value in (self.scheme, self.host, self.path, self._content_key()):
+            if value is None:
+                digest.update(b"\x00")
+                continue
+            digest.update(b"\x01" + len(value).to_bytes(8, "big"))
+            for start in range(0, len(value), DIGEST_CHUNK_SIZE):
+                digest.update(value[start:start + DIGEST_CHUNK_SIZE].encode("utf-8", "surrogatepass"))
+        return digest.digest()
 
 
 class NormalizedRequest:
+    __slots__ = ("request_id", "normalized_id")
+
     def __init__(self, request_id: int, normalized_id: int):
         self.request_id = request_id
         self.normalized_id = normalized_id
@@ -0,0 +1,124 @@
+import array
+import hashlib
+import io
+import os
+import pickle
+import re
+import sys
+import time
+from importlib import metadata
+from pathlib import Path
+
+from adblockparser import AdblockRules
+
+try:
+    # private to CPython 3.11 and later, elsewhere the patterns are pickled as their source
+    import _sre
+    from re import _compiler, _parser
+except ImportError:
+    _sre = _compiler = _parser = None
+
+CACHE_FORMAT = 1
+PARSER_VERSION = metadata.version("adblockparser")
+MAX_MEM = 2 * 1024 * 1024 * 1024
+
+
+def cache_dir() -> Path:
+    return Path(os.environ.get("ADBLOCK_CACHE_DIR") or Path(__file__).with_name("filterlists") / ".cache")
+
+
+class CacheStatus:
+    def __init__(self, name: str, hit: bool, seconds: float, digest: str):
+        self.name = name
+        self.hit = hit
+        self.seconds = seconds
+        self.digest = digest
+
+    def __repr__(self):
+        return f"CacheStatus({self.name}: {'hit' if self.hit else 'miss'} in {self.seconds:.3f}s)"
+
+
+def load_rules(file_path: Path) -> tuple[AdblockRules, CacheStatus]:
+    start = time.perf_counter()
+    with open(file_path, "rb") as filter_list:
+        raw = filter_list.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    cache_file = cache_dir() / f"{file_path.stem}-{digest[:16]}.pickle"
+    rules = _read_cache(cache_file, _cache_key(digest))
+    hit = rules is not None
+    if not hit:
+        rules = AdblockRules(raw.decode("utf-8").splitlines(keepends=True), max_mem=MAX_MEM)
+        _write_cache(cache_file, _cache_key(digest), rules)
+    status = CacheStatus(file_path.stem, hit, time.perf_counter() - start, digest)
+    print(f"filter list cache {'hit' if hit else 'miss'} for {status.name}: loaded in {status.seconds:.3f}s")
+    return rules, status
+
+
+def _cache_key(digest: str) -> tuple:
+    # compiled regex code is only valid for the interpreter that produced it
+    return CACHE_FORMAT, digest, PARSER_VERSION, getattr(_sre, "MAGIC", None), sys.implementation.name, \
+        sys.version_info[:2]
+
+
+def _read_cache(cache_file: Path, key: tuple) -> AdblockRules | None:
+    if not cache_file.exists():
+        return None
+    try:
+        with open(cache_file, "rb") as f:
+            cached_key, rules = pickle.load(f)
+    except Exception as e:
+        print(f"ignoring unreadable filter list cache {cache_file}: {e}", file=sys.stderr)
+        return None
+    return rules if cached_key == key else None
+
+
+def _write_cache(cache_file: Path, key: tuple, rules: AdblockRules) -> None:
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    buffer = io.BytesIO()
+    try:
+        _RulePickler(buffer).dump((key, rules))
+    except Exception as e:
+        # e.g. re2 patterns, which cannot be pickled
+        print(f"not caching filter list {cache_file.stem}: {e}", file=sys.stderr)
+        return
+    for stale in cache_file.parent.glob(f"{cache_file.stem.rsplit('-', 1)[0]}-*.pickle"):
+        stale.unlink(missing_ok=True)
+    tmp_file = cache_file.with_suffix(".tmp")
+    tmp_file.write_bytes(buffer.getvalue())
+    tmp_file.replace(cache_file)
+
+
+class _RulePickler(pickle.Pickler):
+    # Unpickling a re.Pattern recompiles it from source, which for the combined
+    # filter list regexes costs as much as building the rules. Store the compiled
+    # sre code instead so loading only has to hand it back to _sre.
+    def __init__(self, file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def reducer_override(self, obj):
+        if _sre is not None and isinstance(obj, re.Pattern) and isinstance(obj.pattern, str):
+            try:
+                return _restore_pattern, _compiled_args(obj)
+            except AttributeError:
+                # the sre internals changed, the pattern is recompiled on load
+                pass
+        return NotImplemented
+
+
+def _compiled_args(pattern: re.Pattern) -> tuple:
+    parsed = _parser.parse(pattern.pattern, pattern.flags)
+    code = array.array("I", _compiler._code(parsed, pattern.flags))
+    groupindex = dict(parsed.state.groupdict)
+    indexgroup = [None] * parsed.state.groups
+    for k, i in groupindex.items():
+        indexgroup[i] = k
+    return pattern.pattern, pattern.flags | parsed.state.flags, code, parsed.state.groups - 1, \
+        groupindex, tuple(indexgroup)
+
+
+def _restore_pattern(pattern, flags, code, groups, groupindex, indexgroup) -> re.Pattern:
+    try:
+        return _sre.compile(pattern, flags, code.tolist(), groups, groupindex, indexgroup)
+    except (TypeError, RuntimeError):
+        return re.compile(pattern, flags)
+
@@ -0,0 +1,7 @@
+import os
+import sys
+from pathlib import Path
+
+# the scripts import each other by module name from their directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TQDM_DISABLE", "1")
@@ -0,0 +1,9 @@
+from adblock_addon import AdBlockAddon, parse_filter_list_names
+
+
+def test_all_filter_lists_load():
+    names = parse_filter_list_names("all")
+    addon = AdBlockAddon(names)
+    # ruadlist is the only bundled list adblockparser cannot compile
+    assert sorted(addon.rules) == sorted(name for name in names if name != "ruadlist")
+    assert set(addon.matchers) == set(addon.rules)
@@ -0,0 +1,36 @@
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import benchmark
+from adblock_addon import parse_filter_list_names
+from benchmark import compare_engines
+
+SCRIPT = Path(benchmark.__file__)
+
+
+@pytest.mark.parametrize("filter_list_name", parse_filter_list_names("all"))
+def test_engines_agree(filter_list_name):
+    args = argparse.Namespace(compare_urls=100, seed=benchmark.SEED, duplication=benchmark.DUPLICATION,
+                              hosts=benchmark.HOSTS)
+    [result] = compare_engines([filter_list_name], args)
+    if "skipped" in result:
+        # as in AdBlockAddon, lists adblockparser cannot compile are left out
+        pytest.skip(result["skipped"])
+    assert result["urls"] > 0
+    assert result["blocked"] > 0
+    assert result["mismatch_count"] == 0, result["mismatches"]
+
+
+def test_compare_writes_report(tmp_path):
+    output = tmp_path / "compare.json"
+    process = subprocess.run([sys.executable, str(SCRIPT), "--compare-engines", "--filter-list", "ruadlist",
+                              "--output", str(output)], cwd=SCRIPT.parent, capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
+    results = json.loads(output.read_text())["results"]
+    assert [r["filter_list"] for r in results] == ["ruadlist"]
+    assert "skipped" in results[0]
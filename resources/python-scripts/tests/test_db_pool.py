@@ -0,0 +1,26 @@
+import multiprocessing
+
+import db_pool
+
+# a stand-in for the pool of the parent, a forked child must neither use nor drop it
+PARENT_POOL = object()
+
+
+def inherited_state() -> tuple[bool, bool]:
+    return db_pool._pool is None, any(p is PARENT_POOL for p in db_pool._inherited)
+
+
+def test_forked_child_keeps_the_inherited_pool(monkeypatch):
+    monkeypatch.setattr(db_pool, "_pool", PARENT_POOL)
+    with multiprocessing.get_context("fork").Pool(1) as workers:
+        assert workers.apply(inherited_state) == (True, True)
+    assert db_pool._pool is PARENT_POOL
+    assert db_pool._inherited == []
+
+
+def test_session_options_only_set_configured_values(monkeypatch):
+    monkeypatch.setattr(db_pool, "_settings", dict(db_pool._settings))
+    db_pool.configure()
+    assert db_pool._session_options() == ""
+    db_pool.configure(statement_timeout="30min", work_mem="256MB")
+    assert db_pool._session_options() == "-c statement_timeout=30min -c work_mem=256MB"
@@ -0,0 +1,204 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from benchmark import StubCompletions, start_stub_server
+from llm import (LLM, MODEL_CONTEXT_TOKENS, MODEL_OUTPUT_TOKENS, AsyncLLM, TokenBucket, completion_arguments,
+                 estimate_tokens, gpt3, gpt3_16k, gpt4, pack_prompts, packed_completion_arguments, parse_packed_answer)
+from prompt_cache import PromptCache
+
+
+class ScriptedCompletions(StubCompletions):
+    # records the requested models and concurrent requests, and fails the first requests as scripted
+    lock = threading.Lock()
+    models: list[str] = []
+    in_flight = 0
+    max_in_flight = 0
+    rate_limited = 0
+    context_exceeded: set[str] = set()
+
+    @classmethod
+    def reset(cls, latency: float = 0.0, rate_limited: int = 0, context_exceeded: set[str] | None = None) -> None:
+        cls.latency = latency
+        cls.models = []
+        cls.in_flight = 0
+        cls.max_in_flight = 0
+        cls.rate_limited = rate_limited
+        cls.context_exceeded = set() if context_exceeded is None else context_exceeded
+
+    def complete(self, body: dict) -> None:
+        cls = type(self)
+        with cls.lock:
+            cls.models.append(body["model"])
+            limited = cls.rate_limited > 0
+            cls.rate_limited -= 1 if limited else 0
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        try:
+            if limited:
+                # retry-after-ms keeps the retries of the openai client itself short
+                self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                               "code": "rate_limit_exceeded"}}, {"retry-after-ms": "1"})
+            elif body["model"] in cls.context_exceeded:
+                self.send_json(400, {"error": {"message": "This model's maximum context length is 4097 tokens",
+                                               "type": "invalid_request_error", "param": "messages",
+                                               "code": "context_length_exceeded"}})
+            else:
+                super().complete(body)
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+
+@pytest.fixture
+def stub():
+    ScriptedCompletions.reset()
+    server = start_stub_server(0.0, ScriptedCompletions)
+    yield ScriptedCompletions
+    server.shutdown()
+    server.server_close()
+
+
+def test_concurrency_cap(stub):
+    stub.reset(latency=0.1)
+
+    async def run():
+        llm = AsyncLLM(gpt4, "test", concurrency=2)
+        try:
+            return await asyncio.gather(*[llm.get_private_data(f"GET /track?id={i}") for i in range(8)])
+        finally:
+            await llm.close()
+
+    results = asyncio.run(run())
+    assert all(len(result) > 0 for result in results)
+    assert len(stub.models) == 8
+    assert stub.max_in_flight == 2
+
+
+def test_token_bucket_waits_for_refill():
+    async def run():
+        bucket = TokenBucket(600)
+        await bucket.acquire(600)
+        start = time.monotonic()
+        await bucket.acquire(5)
+        return time.monotonic() - start
+
+    # 600 per minute refill 10 per second, so 5 take half a second
+    assert asyncio.run(run()) == pytest.approx(0.5, abs=0.2)
+
+
+def test_token_bucket_limits_requests(stub):
+    async def run():
+        llm = AsyncLLM(gpt4, "test", requests_per_minute=120)
+        # the first two requests empty the bucket, the third waits for a refill of 2 per second
+        llm._requests.available = 2
+        try:
+            start = time.monotonic()
+            await asyncio.gather(*[llm.get_private_data(f"GET /pixel?id={i}") for i in range(3)])
+            return time.monotonic() - start
+        finally:
+            await llm.close()
+
+    assert asyncio.run(run()) >= 0.4
+    assert len(stub.models) == 3
+
+
+def test_rate_limit_backoff(stub):
+    # the openai client retries twice itself, the fourth rate limited request is retried by the backoff
+    stub.reset(rate_limited=4)
+    result = LLM(gpt4, "test").get_private_data("GET /collect?uid=1")
+    assert len(result) > 0
+    assert stub.models == [gpt4] * 5
+
+
+def test_rate_limit_backoff_async(stub):
+    stub.reset(rate_limited=4)
+
+    async def run():
+        llm = AsyncLLM(gpt4, "test")
+        try:
+            return await llm.get_private_data("GET /collect?uid=1")
+        finally:
+            await llm.close()
+
+    assert len(asyncio.run(run())) > 0
+    assert stub.models == [gpt4] * 5
+
+
+def test_context_length_fallback(stub):
+    stub.reset(context_exceeded={gpt3})
+    result = LLM(gpt3, "test").get_private_data("GET /collect?uid=2")
+    assert len(result) > 0
+    assert stub.models == [gpt3, gpt3_16k]
+
+
+def test_context_length_fallback_async(stub):
+    stub.reset(context_exceeded={gpt3})
+
+    async def run():
+        llm = AsyncLLM(gpt3, "test")
+        try:
+            return await llm.get_private_data("GET /collect?uid=2")
+        finally:
+            await llm.close()
+
+    assert len(asyncio.run(run())) > 0
+    assert stub.models == [gpt3, gpt3_16k]
+
+
+def test_packs_fit_the_context():
+    prompts = [(i, f"POST /v1/events?id={i} " + "k=v&" * 200) for i in range(60)]
+    for model in (gpt3, gpt3_16k, gpt4):
+        packs = pack_prompts(model, prompts)
+        assert [item for pack in packs for item in pack] == prompts
+        for pack in packs:
+            arguments = packed_completion_arguments(model, [prompt for _, prompt in pack])
+            assert estimate_tokens(arguments) <= MODEL_CONTEXT_TOKENS[model]
+            assert arguments["max_tokens"] <= MODEL_OUTPUT_TOKENS[model]
+    # the 4k context of gpt3 still holds several payloads with their answers
+    assert 1 < max(len(pack) for pack in pack_prompts(gpt3, prompts)) < len(prompts)
+
+
+def test_packed_answers_are_cached(stub, tmp_path):
+    prompts = [f"GET /pixel?id={i}" for i in range(5)]
+    cache = PromptCache(tmp_path / "cache.sqlite")
+    try:
+        results = LLM(gpt4, "test", cache=cache).get_private_data_batch(prompts)
+        assert len(stub.models) == 1
+        for prompt, result in zip(prompts, results):
+            assert cache.get(completion_arguments(gpt4, prompt), "test", gpt4) == result
+        assert LLM(gpt4, "test", cache=cache).get_private_data_batch(prompts) == results
+        assert len(stub.models) == 1
+    finally:
+        cache.close()
+
+
+def test_packed_answers_are_cached_async(stub, tmp_path):
+    prompts = [f"GET /pixel?id={i}" for i in range(5)]
+    cache = PromptCache(tmp_path / "cache.sqlite")
+
+    async def run():
+        llm = AsyncLLM(gpt4, "test", cache=cache)
+        try:
+            return await llm.get_private_data_batch(prompts)
+        finally:
+            await llm.close()
+
+    try:
+        results = asyncio.run(run())
+        assert len(stub.models) == 1
+        assert asyncio.run(run()) == results
+        assert len(stub.models) == 1
+    finally:
+        cache.close()
+
+
+def test_packed_answer_with_end_markers():
+    answer = "\n".join(["<<<payload 1>>>", "OS,os,android", "<<<end 1>>>",
+                        "<<<payload 2>>>", "no-data", "<<<end 2>>>",
+                        "<<<payload 3>>>", "Language,lang,de-DE", "<<<end 3>>>"])
+    sections = parse_packed_answer(answer, 3, False, "test", gpt4)
+    assert {i: [(pd.category, pd.key, pd.value) for pd in data] for i, data in sections.items()} == {
+        1: [("OS", "os", "android")], 2: [], 3: [("Language", "lang", "de-DE")]}
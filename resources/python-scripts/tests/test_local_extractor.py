@@ -0,0 +1,21 @@
+import pytest
+
+from local_extractor import LocalExtractor
+
+
+@pytest.fixture
+def extractor():
+    return LocalExtractor()
+
+
+@pytest.mark.parametrize("payload", ['{"os":"android","version":"1.4.2","name":"Pixel 7"}',
+                                     "os=android&v=13&lang=de",
+                                     "<device os=\"android\" name=\"Pixel 7\"/>"])
+def test_ambiguous_keys_go_to_the_llm(extractor, payload):
+    assert extractor.extract(payload, "test") is None
+
+
+def test_known_keys_are_resolved(extractor):
+    private_data = extractor.extract('{"device":{"os":"android","osv":"13"},"ts":1700000000,"lang":"de"}', "test")
+    assert [(pd.category, pd.key, pd.value) for pd in private_data] == [
+        ("OS", "device.os", "android"), ("OS", "device.osv", "13"), ("Language", "lang", "de")]
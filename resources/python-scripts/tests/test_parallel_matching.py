@@ -0,0 +1,28 @@
+from benchmark import MemoryAdBlockAddon, generate_corpus
+from request import Request
+
+FILTER_LIST = "peterlowe"
+
+
+class RecordingAdBlockAddon(MemoryAdBlockAddon):
+    def __init__(self, rows, workers: int):
+        super().__init__([FILTER_LIST], rows)
+        self.workers = workers
+        self.matches: dict[int, bool] = dict()
+
+    def _save_results(self, filter_list_name: str, list_id: int, list_version: int, requests: list[Request]) -> None:
+        self.matches.update((r.req_id, r.match) for r in requests)
+
+
+def test_pool_matches_like_serial():
+    rows = generate_corpus(2_000, seed=7, duplication=0.3, host_count=300)
+    # hosts the list blocks, so both results are not only misses
+    rows += [(10_000 + i, "https", host, f"/collect?i={i}", "")
+             for i, host in enumerate(["www.google-analytics.com", "doubleclick.net", "ads.example.com"])]
+    serial = RecordingAdBlockAddon(rows, workers=1)
+    serial.match_requests(0)
+    pooled = RecordingAdBlockAddon(rows, workers=2)
+    pooled.match_requests(0)
+    assert len(serial.matches) == len(rows)
+    assert any(serial.matches.values())
+    assert pooled.matches == serial.matches
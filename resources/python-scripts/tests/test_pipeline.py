@@ -0,0 +1,17 @@
+from benchmark import MemoryDatabase, generate_corpus
+from llm_traffic_analysis import analysis_selection, match_modes
+from pipeline import Pipeline
+
+APPS = ["com.example.one", "com.example.two"]
+
+
+def test_selection_matches_llm_traffic_analysis():
+    db = MemoryDatabase(generate_corpus(10))
+    for match_mode in match_modes:
+        for only_apps in ([], APPS):
+            pipeline = Pipeline(db, ["normalize"], None, match_mode, only_apps)
+            assert pipeline.selection() == analysis_selection(match_mode, only_apps)
+    # the tracking mode analyzes the matched requests of all apps
+    assert Pipeline(db, ["normalize"], None, match_modes[0], APPS).only_apps == set()
+    assert analysis_selection(match_modes[0], APPS) == match_modes[0]
+    assert analysis_selection(match_modes[1], APPS) != match_modes[1]
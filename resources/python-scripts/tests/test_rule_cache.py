@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import rule_cache
+from adblock_addon import FILTER_LIST_DIR
+
+FILTER_LIST = FILTER_LIST_DIR / "nocoin.txt"
+URL = "https://coinhive.com/lib/coinhive.min.js"
+
+
+def test_cache_hit_matches_like_the_compiled_rules(tmp_path, monkeypatch):
+    monkeypatch.setenv("ADBLOCK_CACHE_DIR", str(tmp_path))
+    compiled, status = rule_cache.load_rules(FILTER_LIST)
+    assert not status.hit
+    cached, status = rule_cache.load_rules(FILTER_LIST)
+    assert status.hit
+    assert cached.should_block(URL) == compiled.should_block(URL) is True
+
+
+def test_cache_without_the_sre_internals(tmp_path):
+    # as on interpreters without _sre, importing the addon and the cache still work
+    script = ("import sys; sys.modules['_sre'] = None\n"
+              "import adblock_addon, rule_cache\n"
+              "assert rule_cache._sre is None\n"
+              "for _ in range(2):\n"
+              f"    rules, status = rule_cache.load_rules(adblock_addon.FILTER_LIST_DIR / 'nocoin.txt')\n"
+              f"    assert rules.should_block({URL!r})\n"
+              "print(status.hit)\n")
+    process = subprocess.run([sys.executable, "-c", script], cwd=Path(rule_cache.__file__).parent,
+                             env={**os.environ, "ADBLOCK_CACHE_DIR": str(tmp_path)}, capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
+    assert process.stdout.strip().splitlines()[-1] == "True"